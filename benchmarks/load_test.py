@@ -0,0 +1,386 @@
+''' Load test of VoxelViz: simulates students using the app at the same
+time, at increasing numbers of concurrent sessions.
+
+The app is started with gunicorn (like in examples/) on synthetic data, or
+given with --url. Each session replays random interactions as the browser
+would send them to _dash-update-component: switching contrasts, scrubbing
+through slices, sweeping over the brain with the mouse (hover) and toggling
+between the time and frequency domain. Per number of sessions, the
+throughput, the latency of each callback and the memory of each worker
+are reported, e.g.:
+
+    $ python benchmarks/load_test.py --workers 3 --sessions 1,4,16,32
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import tempfile
+import threading
+import subprocess
+import http.client
+import os.path as op
+from urllib.parse import urlparse
+from collections import defaultdict
+import click
+import numpy as np
+
+ROOT = op.dirname(op.dirname(op.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from tests.fixtures import make_dataset  # noqa: E402
+
+# Module with which gunicorn serves the app on the synthetic data
+WSGI_MODULE = '''from voxelviz.app import vxv
+app, server = vxv(%r, %r, True)
+'''
+
+# Relative frequency of the interactions of a session
+ACTIONS = [('hover', 0.4), ('scrub', 0.35), ('contrast', 0.1), ('datatype', 0.1),
+           ('threshold', 0.05)]
+
+
+class Client(object):
+    ''' Sends requests to the app like the browser of a single session. '''
+
+    def __init__(self, url, timeout=60):
+        url = urlparse(url)
+        self.host, self.port = url.hostname, url.port or 80
+        self.prefix = url.path.rstrip('/')
+        self.timeout = timeout
+
+    def request(self, method, path, body=None):
+        ''' Returns the status, body and latency (in s) of a request. '''
+
+        # The (sync) workers of gunicorn close the connection after each request
+        conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        headers = {'Content-Type': 'application/json'} if body is not None else {}
+        start = time.perf_counter()
+        try:
+            conn.request(method, self.prefix + path, body=body, headers=headers)
+            response = conn.getresponse()
+            data = response.read()
+            status = response.status
+        except (OSError, http.client.HTTPException):
+            data, status = b'', 0
+        finally:
+            conn.close()
+        return status, data, time.perf_counter() - start
+
+    def get_json(self, path):
+        status, data, _ = self.request('GET', path)
+        if status != 200:
+            raise RuntimeError('GET %s failed (%i)' % (path, status))
+        return json.loads(data.decode())
+
+
+def layout_values(node, values):
+    ''' Collects the properties of all components (with an id) of a layout. '''
+
+    if isinstance(node, list):
+        for child in node:
+            layout_values(child, values)
+    elif isinstance(node, dict):
+        props = node.get('props', {})
+        if 'id' in props:
+            for prop, value in props.items():
+                if prop not in ('id', 'children'):
+                    values['%s.%s' % (props['id'], prop)] = value
+        layout_values(props.get('children'), values)
+    return values
+
+
+class Session(object):
+    ''' A student using the app: keeps the state of the components and sends
+    the requests that the browser would send after each interaction.
+
+    Parameters
+    ----------
+    client : Client
+        Client of the app
+    dependencies : list
+        Callbacks of the app (from _dash-dependencies)
+    initial : dict
+        Initial values of the components (from _dash-layout)
+    think : float
+        Time (in s) between consecutive events of an interaction
+    seed : int
+        Seed of the random interactions
+    '''
+
+    def __init__(self, client, dependencies, initial, think, seed):
+        self.client = client
+        self.think = think
+        self.rng = np.random.RandomState(seed)
+        self.state = dict(initial)
+        self.contrasts = [opt['value'] for opt in initial['contrast.options']]
+
+        # Only the callbacks on the server result in requests
+        self.callbacks = [dep for dep in dependencies
+                          if not dep.get('clientside_function')]
+        self.inputs = set('%s.%s' % (i['id'], i['property'])
+                          for dep in self.callbacks for i in dep['inputs'])
+        self.results = []  # (callback, status, latency, bytes)
+
+    def change(self, prop, value):
+        ''' Changes a property and fires the callbacks that depend on it. '''
+
+        self.state[prop] = value
+        for dep in self.callbacks:
+            inputs = ['%s.%s' % (i['id'], i['property']) for i in dep['inputs']]
+            if prop in inputs:
+                self.fire(dep, prop)
+
+    def fire(self, dep, prop):
+
+        def values(items):
+            return [dict(id=i['id'], property=i['property'],
+                         value=self.state.get('%s.%s' % (i['id'], i['property'])))
+                    for i in items]
+
+        body = json.dumps(dict(output=dep['output'], inputs=values(dep['inputs']),
+                               state=values(dep['state']), changedPropIds=[prop]))
+        status, data, latency = self.client.request(
+            'POST', '/_dash-update-component', body)
+        self.results.append((dep['output'], status, latency, len(data)))
+
+        if status != 200:
+            return
+
+        output = json.loads(data.decode())['response']['props']
+        for key, value in output.items():
+            self.state['%s.%s' % (dep['output'].split('.')[0], key)] = value
+
+        # Images of slices rendered on the server are loaded by the browser
+        images = (output.get('figure') or {}).get('layout', {}).get('images', [])
+        for image in images:
+            status, data, latency = self.client.request('GET', image['source'])
+            self.results.append(('slice_image', status, latency, len(data)))
+
+    def run(self, stop):
+        ''' Replays random interactions until stop is set. '''
+
+        actions = [action for action, _ in ACTIONS]
+        weights = np.array([weight for _, weight in ACTIONS])
+        while not stop.is_set():
+            action = actions[self.rng.choice(len(actions), p=weights / weights.sum())]
+            getattr(self, action)()
+            time.sleep(self.think)
+
+    def hover(self):
+        # A sweep of the mouse over the brain; the browser coalesces the
+        # hover events, so one request per hover_interval at most
+        start, end = self.rng.randint(0, 60, size=(2, 2))
+        prop = 'voxel.data' if 'voxel.data' in self.inputs else 'brainplot.hoverData'
+        for t in np.linspace(0, 1, self.rng.randint(5, 20)):
+            x, y = start + t * (end - start)
+            point = {'x': float(x), 'y': float(y)}
+            if prop == 'brainplot.hoverData':
+                point = {'points': [point]}
+            self.change(prop, point)
+            time.sleep(self.think)
+
+    def scrub(self):
+        # Dragging the slice slider
+        smax = self.state.get('slice.max') or 50
+        sslice = self.state.get('slice.value') or smax // 2
+        step = self.rng.choice([-1, 1])
+        for _ in range(self.rng.randint(3, 15)):
+            sslice = int(min(max(sslice + step, 0), smax - 1))
+            self.change('slice.value', sslice)
+            time.sleep(self.think)
+
+    def contrast(self):
+        self.change('contrast.value', self.contrasts[self.rng.randint(len(self.contrasts))])
+
+    def datatype(self):
+        current = self.state.get('datatype.value')
+        self.change('datatype.value', 'freq' if current == 'time' else 'time')
+
+    def threshold(self):
+        self.change('threshold.value', round(float(self.rng.uniform(1, 5)), 1))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def children(pid):
+    ''' Returns the pids of the child processes (e.g., gunicorn workers). '''
+
+    pids = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % entry) as f:
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        if ppid == pid:
+            pids.append(int(entry))
+    return pids
+
+
+def memory(pid):
+    ''' Returns the resident and proportional (i.e., with shared memory
+    divided over the processes sharing it) memory of a process in MB. '''
+
+    info = {}
+    for fname in ('status', 'smaps_rollup'):
+        try:
+            with open('/proc/%i/%s' % (pid, fname)) as f:
+                for line in f:
+                    key, _, value = line.partition(':')
+                    if key in ('VmRSS', 'VmHWM', 'Pss'):
+                        info[key] = int(value.split()[0]) / 1024.
+        except OSError:
+            pass
+    return info
+
+
+def start_server(data, cfg_file, workers):
+    ''' Starts the app with gunicorn and returns the process and its url. '''
+
+    with open(op.join(data, 'vxv_load_test_app.py'), 'w') as f:
+        f.write(WSGI_MODULE % (cfg_file, data))
+
+    port = free_port()
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [ROOT, data, os.environ.get('PYTHONPATH', '')]))
+    cmd = [sys.executable, '-m', 'gunicorn', '--workers', str(workers),
+           '--preload', '--timeout', '300', '--bind', '127.0.0.1:%i' % port,
+           'vxv_load_test_app:server']
+    proc = subprocess.Popen(cmd, cwd=data, env=env)
+    url = 'http://127.0.0.1:%i' % port
+
+    client = Client(url, timeout=5)
+    for _ in range(600):
+        if proc.poll() is not None:
+            raise RuntimeError('gunicorn exited (%i)' % proc.returncode)
+        if client.request('GET', '/_dash-layout')[0] == 200:
+            return proc, url
+        time.sleep(0.5)
+
+    proc.terminate()
+    raise RuntimeError('The app did not start')
+
+
+def run_level(url, n_sessions, duration, think, seed):
+    ''' Runs n_sessions concurrent sessions for duration seconds and returns
+    their results. '''
+
+    client = Client(url)
+    dependencies = client.get_json('/_dash-dependencies')
+    initial = layout_values(client.get_json('/_dash-layout'), {})
+
+    sessions = [Session(Client(url), dependencies, initial, think, seed + i)
+                for i in range(n_sessions)]
+    stop = threading.Event()
+    threads = [threading.Thread(target=session.run, args=(stop,))
+               for session in sessions]
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    return [result for session in sessions for result in session.results], elapsed
+
+
+def summarize(results, elapsed, n_sessions, worker_memory):
+
+    latencies = defaultdict(list)
+    errors = sum(1 for _, status, _, _ in results if status != 200)
+    for callback, status, latency, _ in results:
+        latencies[callback].append(latency * 1000)
+    every = [latency for values in latencies.values() for latency in values]
+
+    def percentiles(values):
+        return dict(n=len(values), p50=np.percentile(values, 50),
+                    p90=np.percentile(values, 90), p99=np.percentile(values, 99))
+
+    summary = dict(sessions=n_sessions, requests=len(results), errors=errors,
+                   seconds=elapsed, throughput=len(results) / elapsed,
+                   bytes=sum(nbytes for _, _, _, nbytes in results),
+                   latency=percentiles(every) if every else None,
+                   callbacks=dict((callback, percentiles(values))
+                                  for callback, values in latencies.items()),
+                   workers=worker_memory)
+
+    print('\n%i sessions: %i requests (%i errors) in %.1f s, %.1f requests/s, '
+          '%.1f MB sent' % (n_sessions, len(results), errors, elapsed,
+                            summary['throughput'], summary['bytes'] / 1024. ** 2))
+    print('  %-28s %6s %9s %9s %9s' % ('callback', 'n', 'p50 (ms)', 'p90', 'p99'))
+    for callback, stats in sorted(summary['callbacks'].items()):
+        print('  %-28s %6i %9.1f %9.1f %9.1f' % (callback, stats['n'], stats['p50'],
+                                                 stats['p90'], stats['p99']))
+    for pid, info in sorted(worker_memory.items()):
+        print('  worker %-7s RSS %7.1f MB (peak %7.1f MB), PSS %7.1f MB' % (
+            pid, info.get('VmRSS', np.nan), info.get('VmHWM', np.nan),
+            info.get('Pss', np.nan)))
+
+    return summary
+
+
+@click.command()
+@click.option('--url', default=None,
+              help='Url of a running app (default: start one on synthetic data)')
+@click.option('--workers', default=3, help='Number of gunicorn workers')
+@click.option('--sessions', default='1,2,4,8,16',
+              help='Numbers of concurrent sessions (comma-separated)')
+@click.option('--duration', default=15., help='Seconds per number of sessions')
+@click.option('--think', default=0.1,
+              help='Seconds between events (e.g., the hover_interval)')
+@click.option('--kind', type=click.Choice(['native', 'group']), default='native')
+@click.option('--volumes', default=100, help='Number of time points or subjects')
+@click.option('--contrasts', default=3, help='Number of contrasts')
+@click.option('--render', default='heatmap', help='Render mode of the app')
+@click.option('--config', 'extra', multiple=True,
+              help='Other settings of the app as key=json-value, e.g., mask=1')
+@click.option('--seed', default=0)
+@click.option('--json', 'json_file', default=None, help='File to save the results to')
+def main(url, workers, sessions, duration, think, kind, volumes, contrasts,
+         render, extra, seed, json_file):
+
+    data = proc = None
+    if url is None:
+        settings = dict(render=render, cache_dir=None)
+        settings.update((key, json.loads(val)) for key, val in
+                        (item.split('=', 1) for item in extra))
+        data = tempfile.mkdtemp(prefix='vxv_load_')
+        print('Writing %s data to %s ...' % (kind, data))
+        cfg_file = make_dataset(data, kind, volumes, contrasts, **settings)
+        proc, url = start_server(data, cfg_file, workers)
+
+    summaries = []
+    try:
+        for n_sessions in [int(n) for n in sessions.split(',')]:
+            results, elapsed = run_level(url, n_sessions, duration, think, seed)
+            worker_memory = {}
+            if proc is not None:
+                worker_memory = dict((pid, memory(pid)) for pid in children(proc.pid))
+            summaries.append(summarize(results, elapsed, n_sessions, worker_memory))
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+        if data is not None:
+            shutil.rmtree(data)
+
+    if json_file is not None:
+        with open(json_file, 'w') as f:
+            json.dump(summaries, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+''' Benchmarks of the data loaders and Dash callbacks of VoxelViz on
+synthetic data.
+
+Reports the latency (percentiles, in ms), the peak memory allocated during
+a call, the peak RSS of the process (so far) and the size of the response
+of the callbacks, e.g.:
+
+    $ python benchmarks/run_benchmarks.py --kind native --volumes 200
+    $ python benchmarks/run_benchmarks.py --kind group --volumes 30 --json group.json
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import resource
+import tempfile
+import tracemalloc
+import os.path as op
+import click
+import numpy as np
+
+sys.path.insert(0, op.dirname(op.dirname(op.abspath(__file__))))
+
+from tests.fixtures import make_dataset  # noqa: E402
+from voxelviz.app import vxv  # noqa: E402
+from voxelviz.store import load_timeseries  # noqa: E402
+from voxelviz.utils import (load_data, standardize, read_design_file,  # noqa: E402
+                            index_by_slice, fit_glm, calculate_statistics,
+                            load_bundle)
+
+
+def peak_rss():
+    ''' Peak resident memory of this process (in MB). '''
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024. ** (2 if sys.platform == 'darwin' else 1)
+
+
+def measure(name, fn, calls, trace=True):
+    ''' Calls fn with each of the argument tuples in calls and returns the
+    statistics of the calls. Memory allocations are traced in one extra
+    call (as tracing slows down the calls). '''
+
+    times, sizes = [], []
+    for args in calls:
+        start = time.perf_counter()
+        out = fn(*args)
+        times.append((time.perf_counter() - start) * 1000)
+
+        # The callbacks return the response (JSON) as sent to the browser
+        if isinstance(out, (str, bytes)):
+            sizes.append(len(out))
+        del out
+
+    alloc = None
+    if trace:
+        tracemalloc.start()
+        fn(*calls[-1])
+        alloc = tracemalloc.get_traced_memory()[1] / 1024. ** 2
+        tracemalloc.stop()
+
+    result = dict(name=name, n=len(times),
+                  p50=np.percentile(times, 50), p90=np.percentile(times, 90),
+                  p99=np.percentile(times, 99), max=max(times),
+                  alloc_mb=alloc, rss_mb=peak_rss(),
+                  bytes=int(np.mean(sizes)) if sizes else None)
+    report(result)
+    return result
+
+
+def report(result=None):
+
+    if result is None:
+        print('%-34s %5s %9s %9s %9s %9s %10s %9s %10s' %
+              ('benchmark', 'n', 'p50 (ms)', 'p90', 'p99', 'max',
+               'alloc (MB)', 'RSS (MB)', 'bytes'))
+        return
+
+    alloc = '' if result['alloc_mb'] is None else '%.1f' % result['alloc_mb']
+    print('%-34s %5i %9.2f %9.2f %9.2f %9.2f %10s %9.1f %10s' %
+          (result['name'], result['n'], result['p50'], result['p90'],
+           result['p99'], result['max'], alloc, result['rss_mb'],
+           '' if result['bytes'] is None else result['bytes']))
+
+
+def cycle(calls, n):
+    return [calls[i % len(calls)] for i in range(n)]
+
+
+def run(data, cfg_file, repeat, heavy_repeat, seed=0):
+    ''' Runs all benchmarks on a dataset made by make_dataset. '''
+
+    rng = np.random.RandomState(seed)
+    with open(cfg_file) as f:
+        cfg = json.load(f)
+
+    names = list(cfg['mappings'].keys())
+    feat_dir = op.join(data, names[0])
+    func_file = op.join(feat_dir + '.feat', 'filtered_func_data.nii.gz')
+    results = []
+
+    report()
+
+    # Loaders; the first call decodes the NIfTI files, later calls map the
+    # uncompressed cache
+    results.append(measure('load_data (cold)', load_data, [(feat_dir, True)],
+                           trace=False))
+    results.append(measure('load_data (warm)', load_data,
+                           cycle([(feat_dir, True)], repeat)))
+    results.append(measure('read_design_file', read_design_file,
+                           cycle([(feat_dir,)], repeat)))
+
+    func, con = load_data(feat_dir, load_func=True)
+    results.append(measure('load_timeseries', load_timeseries,
+                           cycle([(func_file,)], heavy_repeat)))
+
+    ts = load_timeseries(func_file)
+    results.append(measure('standardize', standardize,
+                           cycle([(ts,)], heavy_repeat)))
+
+    for direction, dim in zip('XYZ', range(3)):
+        slices = [(direction, s, con) for s in range(con.shape[dim])]
+        results.append(measure('index_by_slice %s' % direction,
+                               lambda *args: np.array(index_by_slice(*args)),
+                               cycle(slices, max(repeat, len(slices)))))
+
+    design = read_design_file(feat_dir)
+    results.append(measure('fit_glm', fit_glm,
+                           cycle([(ts, design)], heavy_repeat)))
+
+    # Statistics of a single voxel (as when hovering)
+    grouplevel = con.shape == (91, 109, 91)
+    rows = rng.randint(0, ts.shape[0], size=repeat)
+    pinv = np.linalg.pinv(design)
+    calls = []
+    for row in rows:
+        y = np.asarray(ts[row], dtype=np.float64)
+        calls.append((y, design.dot(pinv.dot(y)), design.shape[1], grouplevel))
+    results.append(measure('calculate_statistics', calculate_statistics, calls))
+
+    results.append(measure('load_bundle', load_bundle,
+                           cycle([(data, names[0], cfg['standardize'])],
+                                 heavy_repeat)))
+
+    # End-to-end: the callbacks of the app, called directly
+    start = time.perf_counter()
+    app, _ = vxv(cfg_file, data, True)
+    print('(app started in %.2f s)' % (time.perf_counter() - start))
+    callbacks = dict((output, info['callback'])
+                     for output, info in app.callback_map.items()
+                     if 'callback' in info)
+
+    shape = con.shape
+    sweeps = [(names[i % len(names)], direction, s)
+              for i, (direction, dim) in enumerate(zip('XYZ', range(3)))
+              for s in rng.randint(0, shape[dim], size=max(1, repeat // 3))]
+
+    if 'brainplot.figure' in callbacks:
+        for overlay in ('tstat', 'stat'):
+            calls = [(2.3, name, direction, int(s), overlay, 0, None)
+                     for name, direction, s in sweeps]
+            results.append(measure('update_brainplot (%s)' % overlay,
+                                   callbacks['brainplot.figure'], calls))
+
+        # Cluster-extent thresholding (the clusters are indexed when loading)
+        calls = [(2.3, name, direction, int(s), 'tstat', 10, None)
+                 for name, direction, s in sweeps]
+        results.append(measure('update_brainplot (extent)',
+                               callbacks['brainplot.figure'], calls))
+
+    thresholds = np.round(rng.uniform(1, 5, size=repeat), 1)
+    calls = [(names[i % len(names)], 'tstat', float(t), 10)
+             for i, t in enumerate(thresholds)]
+    results.append(measure('update_peaks', callbacks['peak.options'], calls))
+
+    if 'volume.data' in callbacks:
+        for overlay in ('tstat', 'stat'):
+            calls = cycle([(name, overlay) for name in names], heavy_repeat)
+            results.append(measure('update_volume (%s)' % overlay,
+                                   callbacks['volume.data'], calls))
+
+    calls = [(direction, name) for name, direction, _ in sweeps]
+    results.append(measure('update_slice_slider', callbacks['slice.max'], calls))
+
+    for datatype in ('time', 'freq'):
+        calls = []
+        for name, direction, s in sweeps:
+            point = {'x': float(rng.randint(0, max(shape))),
+                     'y': float(rng.randint(0, max(shape)))}
+            calls.append((name, direction, int(s), point, ['model'], datatype))
+        results.append(measure('update_timeseries (%s)' % datatype,
+                               callbacks['timeseries.data'], calls))
+
+    return results
+
+
+@click.command()
+@click.option('--kind', type=click.Choice(['native', 'group']), default='native',
+              help='Native-space run or group-level (MNI) data')
+@click.option('--volumes', default=100, help='Number of time points or subjects')
+@click.option('--shape', default=None, help='Spatial shape, e.g., 64x64x36')
+@click.option('--contrasts', default=2, help='Number of contrasts')
+@click.option('--repeat', default=30, help='Calls per benchmark')
+@click.option('--heavy-repeat', default=3,
+              help='Calls per benchmark of whole-dataset operations')
+@click.option('--render', default='heatmap', help='Render mode of the app')
+@click.option('--precision', default='float64', help='Precision of the app')
+@click.option('--directory', default=None,
+              help='Directory for the data (default: temporary, removed afterwards)')
+@click.option('--json', 'json_file', default=None, help='File to save the results to')
+def main(kind, volumes, shape, contrasts, repeat, heavy_repeat, render,
+         precision, directory, json_file):
+
+    tmp = directory is None
+    data = tempfile.mkdtemp(prefix='vxv_bench_') if tmp else directory
+    if not op.isdir(data):
+        os.makedirs(data)
+
+    if shape is not None:
+        shape = tuple(int(n) for n in shape.split('x'))
+
+    try:
+        print('Writing %s data to %s ...' % (kind, data))
+        cfg_file = make_dataset(data, kind, volumes, contrasts, shape,
+                                render=render, precision=precision,
+                                cache_dir=None)
+        results = run(data, cfg_file, repeat, heavy_repeat)
+    finally:
+        if tmp:
+            shutil.rmtree(data)
+
+    if json_file is not None:
+        info = dict(kind=kind, volumes=volumes, shape=shape, render=render,
+                    precision=precision, results=results)
+        with open(json_file, 'w') as f:
+            json.dump(info, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -1 +1 @@
-/home/lukas/VoxelViz/vxvenv/bin/gunicorn --workers 3 --bind unix:voxelviz.sock -m 007 this_app:server
+/home/lukas/VoxelViz/vxvenv/bin/gunicorn --workers 3 --preload --bind unix:voxelviz.sock -m 007 this_app:server
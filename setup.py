@@ -20,5 +20,7 @@ setup(
         [console_scripts]
         vxv=voxelviz.app:vxv_cmd
         vxv_download_data=voxelviz.utils:download_data
+        vxv_warm=voxelviz.app:warm_cmd
+        vxv_build=voxelviz.build:build_cmd
     '''
 )
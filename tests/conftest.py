@@ -0,0 +1,12 @@
+import pytest
+
+from fixtures import make_feat
+
+
+@pytest.fixture(scope='session')
+def data(tmp_path_factory):
+    ''' Directory with a small synthetic (native space) contrast. '''
+
+    directory = str(tmp_path_factory.mktemp('data'))
+    make_feat(directory, 'contrast1', (16, 14, 10), 40)
+    return directory
@@ -0,0 +1,122 @@
+''' Synthetic FSL .feat directories for the tests and benchmarks (no real
+data or network needed). '''
+
+import os
+import json
+import os.path as op
+import numpy as np
+from collections import OrderedDict
+
+# MNI (2 mm) space of group-level data; VoxelViz treats data of this shape
+# as subjects instead of a timeseries
+MNI_SHAPE = (91, 109, 91)
+NATIVE_SHAPE = (64, 64, 36)
+
+
+def brain_mask(shape):
+    ''' Ellipsoid filling most of the volume, like a brain. '''
+    grid = np.meshgrid(*[np.linspace(-1, 1, n) for n in shape], indexing='ij')
+    return sum(g ** 2 for g in grid) < 0.8
+
+
+def make_feat(directory, name, shape, n_vols, tr=2.0, grouplevel=False, seed=0):
+    ''' Writes a .feat directory with filtered_func_data, stats/tstat1 and
+    design.mat.
+
+    Parameters
+    ----------
+    directory : str
+        Directory to write <name>.feat to
+    name : str
+        Name of the contrast
+    shape : tuple
+        Spatial shape (x, y, z) of the volumes
+    n_vols : int
+        Number of volumes (time points or subjects)
+    tr : float
+        Repetition time (in seconds)
+    grouplevel : bool
+        Whether to write a group-level design (intercept only)
+    seed : int
+        Seed of the random data
+    '''
+
+    import nibabel as nib
+
+    rng = np.random.RandomState(seed)
+    path = op.join(directory, name + '.feat')
+    if not op.isdir(op.join(path, 'stats')):
+        os.makedirs(op.join(path, 'stats'))
+
+    mask = brain_mask(shape)
+
+    if grouplevel:
+        design = np.ones((n_vols, 1))
+    else:
+        t = np.arange(n_vols) * tr
+        block = (np.sin(2 * np.pi * t / 40.) > 0).astype(float)
+        design = np.column_stack([block, np.cos(2 * np.pi * t / 100.)])
+
+    # Signal in part of the brain, noise everywhere in the brain
+    func = np.zeros(shape + (n_vols,), dtype=np.float32)
+    active = mask & (rng.rand(*shape) < 0.1)
+    func[mask] = 100 + rng.randn(int(mask.sum()), n_vols) * 5
+    func[active] += 3 * design[:, -1]
+
+    tstat = np.zeros(shape, dtype=np.float32)
+    tstat[mask] = rng.randn(int(mask.sum())) * 1.5
+    tstat[active] += 4
+
+    affine = np.diag([2., 2., 2., 1.])
+    img = nib.Nifti1Image(func, affine)
+    img.header.set_zooms((2., 2., 2., tr))
+    img.header.set_xyzt_units('mm', 'sec')
+    nib.save(img, op.join(path, 'filtered_func_data.nii.gz'))
+    nib.save(nib.Nifti1Image(tstat, affine), op.join(path, 'stats', 'tstat1.nii.gz'))
+
+    with open(op.join(path, 'design.mat'), 'w') as f:
+        f.write('/NumWaves\t%i\n/NumPoints\t%i\n/PPheights\t%s\n\n/Matrix\n' %
+                (design.shape[1], n_vols, ' '.join(['1'] * design.shape[1])))
+        np.savetxt(f, design, fmt='%.6f')
+
+    return path
+
+
+def make_dataset(directory, kind='native', n_vols=100, n_contrasts=2,
+                 shape=None, **config):
+    ''' Writes n_contrasts .feat directories and a config.json (with the
+    given settings) and returns the path to the config.
+
+    Parameters
+    ----------
+    directory : str
+        Directory to write the data to
+    kind : str
+        'native' (a run in native space) or 'group' (subjects in MNI space)
+    n_vols : int
+        Number of time points or subjects
+    n_contrasts : int
+        Number of contrasts (mappings)
+    shape : tuple
+        Spatial shape (default: NATIVE_SHAPE or MNI_SHAPE)
+    '''
+
+    grouplevel = kind == 'group'
+    if shape is None:
+        shape = MNI_SHAPE if grouplevel else NATIVE_SHAPE
+
+    mappings = OrderedDict()
+    for i in range(n_contrasts):
+        name = 'contrast%i' % (i + 1)
+        make_feat(directory, name, tuple(shape), n_vols, grouplevel=grouplevel,
+                  seed=i)
+        mappings[name] = 'Contrast %i' % (i + 1)
+
+    cfg = OrderedDict(standardize=1, mappings=mappings)
+    cfg.update(config)
+
+    cfg_file = op.join(directory, 'config.json')
+    with open(cfg_file, 'w') as f:
+        json.dump(cfg, f, indent=4)
+
+    return cfg_file
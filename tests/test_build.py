@@ -0,0 +1,36 @@
+import threading
+
+from fixtures import make_feat
+from voxelviz.build import build_all, open_built
+
+SETTINGS = dict(standardize_func=1, mask=0, precision='float32')
+
+
+def test_build_all_builds_each_bundle_once(tmp_path):
+    data, names = str(tmp_path), ['contrast1', 'contrast2']
+    for i, name in enumerate(names):
+        make_feat(data, name, (10, 9, 6), 20, seed=i)
+
+    # Like gunicorn workers building the same data at once: each bundle is
+    # built by one of them, after which all of them can open it
+    built, results, opened = [], [], []
+
+    def build():
+        results.append(build_all(data, names, SETTINGS, jobs=1,
+                                 callback=built.append))
+        opened.append(all(open_built(data, name, SETTINGS) is not None
+                          for name in names))
+
+    threads = [threading.Thread(target=build) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(built) == names and opened == [True] * 3
+    assert sorted(name for result in results for name in result) == names
+
+    assert build_all(data, names, SETTINGS, jobs=1) == []
+    assert build_all(data, names[:1], SETTINGS, jobs=1, force=True) == names[:1]
+    other = dict(SETTINGS, precision='float64')
+    assert open_built(data, names[0], other) is None
@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+from scipy import ndimage
+
+from voxelviz.clusters import (ClusterIndex, index_clusters, cluster_arrays,
+                               bundle_clusters)
+from voxelviz.utils import index_by_slice, load_bundle, overlay_volume
+
+
+@pytest.fixture(scope='module')
+def vol():
+    rng = np.random.RandomState(0)
+    return (ndimage.gaussian_filter(rng.randn(20, 18, 12), 1.2) * 10).astype(np.float32)
+
+
+def label_sizes(vol, threshold):
+    # Size of the cluster of each voxel (0 below threshold), labeling the
+    # positive and negative values separately
+    structure = ndimage.generate_binary_structure(3, 3)
+    sizes = np.zeros(vol.shape, dtype=int)
+    for above in (vol >= threshold, vol <= -threshold):
+        labels, _ = ndimage.label(above, structure)
+        sizes[above] = np.bincount(labels.ravel())[labels[above]]
+    return sizes
+
+
+@pytest.mark.parametrize('threshold', [0.5, 1.0, 2.3, 3.1])
+def test_cluster_sizes_match_ndimage(vol, threshold):
+    index = ClusterIndex(index_clusters(vol))
+    expected = label_sizes(vol, threshold)
+
+    np.testing.assert_array_equal(index.cluster_sizes(threshold, index.rank),
+                                  expected)
+    for direction in 'XYZ':
+        np.testing.assert_array_equal(
+            index.slice_mask(threshold, 10, direction, 5),
+            index_by_slice(direction, 5, expected) >= 10)
+
+
+def test_list_peaks(vol):
+    index = ClusterIndex(index_clusters(vol))
+    sizes = label_sizes(vol, 1.0)
+    peaks = index.list_peaks(1.0, extent=5)
+
+    assert peaks and all(size >= 5 for _, size in peaks)
+    values = [abs(vol[voxel]) for voxel, _ in peaks]
+    assert values == sorted(values, reverse=True)
+    for voxel, size in peaks:
+        assert sizes[voxel] == size
+    assert len(index.list_peaks(1.0, extent=5, n=2)) == min(2, len(peaks))
+
+
+def test_outside_steps(vol):
+    index = ClusterIndex(index_clusters(vol, max_threshold=2.))
+    assert index.list_peaks(0.) == [] and index.list_peaks(2.5) == []
+    assert not index.cluster_sizes(2.5, index.rank).any()
+
+    empty = ClusterIndex(index_clusters(np.zeros((3, 3, 3))))
+    assert empty.list_peaks(1.) == []
+
+
+def test_bundle_clusters(data):
+    bundle = load_bundle(data, 'contrast1')
+    masked = load_bundle(data, 'contrast1', mask=True)
+
+    # Only the clusters of the tstat are indexed when loading
+    tstat = bundle_clusters(bundle, 'tstat')
+    assert tstat.list_peaks(2.3, 2) == \
+        bundle_clusters(masked, 'tstat').list_peaks(2.3, 2)
+    assert tstat.list_peaks(2.3, 2) == \
+        ClusterIndex(index_clusters(bundle['contrast'])).list_peaks(2.3, 2)
+    assert bundle_clusters(bundle, 'stat') is None
+
+    for overlay in ('stat', 'r2'):
+        bundle.update(cluster_arrays(bundle, overlay))
+        masked.update(cluster_arrays(masked, overlay))
+        index = bundle_clusters(bundle, overlay)
+        np.testing.assert_array_equal(index.cluster_sizes(1., index.rank),
+                                      label_sizes(overlay_volume(bundle, overlay), 1.))
+        for key in bundle:
+            if key.startswith('clusters_%s_' % overlay):
+                np.testing.assert_array_equal(masked[key], bundle[key], err_msg=key)
+
+    assert all(key in load_bundle(data, 'contrast1', all_clusters=True)
+               for key in bundle if key.startswith('clusters_'))
@@ -0,0 +1,63 @@
+import os
+import json
+
+from voxelviz.metrics import (REGISTRY, Metrics, save_snapshot, render_shared,
+                              AGGREGATE_FILE)
+
+
+def parse(text):
+    # Value of each line (without comments) of the Prometheus format
+    return dict(line.rsplit(' ', 1) for line in text.splitlines()
+                if not line.startswith('#'))
+
+
+def test_render_shared_after_fork(tmp_path):
+    directory = str(tmp_path)
+
+    # Loaded once by the parent (e.g., gunicorn --preload), which saves
+    # its metrics itself; the workers it forks start without them
+    REGISTRY.clear()
+    REGISTRY.observe('vxv_contrast_load_seconds', 2., source='data')
+    REGISTRY.set('vxv_contrasts_loaded', 2)
+    save_snapshot(directory)
+
+    for _ in range(3):
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                code = int(bool(REGISTRY.values or REGISTRY.histograms))
+                REGISTRY.inc('vxv_callback_errors_total', callback='slice_image')
+                REGISTRY.set('vxv_contrasts_loaded', 1)
+                save_snapshot(directory)
+            finally:
+                os._exit(code)
+        _, status = os.waitpid(pid, 0)
+        assert status == 0
+
+    for _ in range(2):  # the same after the exited workers are folded
+        values = parse(render_shared(directory))
+        assert values['vxv_contrast_load_seconds_count{source="data"}'] == '1'
+        assert values['vxv_contrast_load_seconds_sum{source="data"}'] == '2.000000'
+        assert values['vxv_callback_errors_total{callback="slice_image"}'] == '3'
+        assert values['vxv_contrasts_loaded{pid="%i"}' % os.getpid()] == '2'
+        assert len([key for key in values if key.startswith('vxv_contrasts_loaded')]) == 1
+
+    assert sorted(f for f in os.listdir(directory) if not f.startswith('.')) == \
+        sorted([AGGREGATE_FILE, '%i.json' % os.getpid()])
+    REGISTRY.clear()
+
+
+def test_add_sums_counters_and_labels_gauges():
+    total = Metrics()
+    for pid in (1, 2):
+        metrics = Metrics()
+        metrics.inc('requests_total', 2, callback='a')
+        metrics.set('bytes', pid * 10)
+        metrics.observe('seconds', 0.02)
+        total.add(json.loads(json.dumps(metrics.snapshot())), pid=pid)
+
+    values = parse(total.render())
+    assert values['requests_total{callback="a"}'] == '4'
+    assert values['bytes{pid="1"}'] == '10' and values['bytes{pid="2"}'] == '20'
+    assert values['seconds_count'] == '2' and values['seconds_bucket{le="0.01"}'] == '0'
@@ -0,0 +1,34 @@
+import zlib
+import struct
+import numpy as np
+
+from voxelviz.render import encode_png
+
+
+def decode_png(data):
+    # Minimal decoder of the (unfiltered RGB) PNGs written by encode_png
+    assert data[:8] == b'\x89PNG\r\n\x1a\n'
+    pos, chunks = 8, {}
+    while pos < len(data):
+        length, = struct.unpack('>I', data[pos:pos + 4])
+        tag, body = data[pos + 4:pos + 8], data[pos + 8:pos + 8 + length]
+        crc, = struct.unpack('>I', data[pos + 8 + length:pos + 12 + length])
+        assert crc == zlib.crc32(tag + body) & 0xffffffff
+        chunks[tag] = chunks.get(tag, b'') + body
+        pos += 12 + length
+
+    width, height, depth, color = struct.unpack('>IIBB', chunks[b'IHDR'][:10])
+    assert (depth, color) == (8, 2)
+    raw = np.frombuffer(zlib.decompress(chunks[b'IDAT']), dtype=np.uint8)
+    raw = raw.reshape(height, width * 3 + 1)
+    assert (raw[:, 0] == 0).all()
+    return raw[:, 1:].reshape(height, width, 3)
+
+
+def test_encode_png_round_trip():
+    rgb = np.random.RandomState(0).randint(0, 256, size=(7, 5, 3)).astype(np.uint8)
+    np.testing.assert_array_equal(decode_png(encode_png(rgb)), rgb)
+
+    # Non-contiguous images (e.g., transposed slices) are encoded as shown
+    np.testing.assert_array_equal(decode_png(encode_png(rgb.transpose(1, 0, 2))),
+                                  rgb.transpose(1, 0, 2))
@@ -0,0 +1,103 @@
+import os
+import os.path as op
+import fcntl
+import numpy as np
+
+from voxelviz.store import ContrastCache, DiskCache, load_shared
+
+
+def test_contrast_cache_evicts_least_recently_used():
+    loads = []
+
+    def loader(name):
+        loads.append(name)
+        return {'func': np.zeros(100, dtype=np.uint8), 'name': name}
+
+    cache = ContrastCache(loader, budget=250)
+    for name in ('a', 'b', 'a', 'c'):
+        assert cache[name]['name'] == name
+
+    # b was used least recently; a is kept (and not loaded again)
+    assert cache.loaded() == ['a', 'c']
+    assert loads == ['a', 'b', 'c'] and (cache.hits, cache.misses) == (1, 3)
+    assert cache.nbytes == 200
+
+    cache['b']
+    assert cache.loaded() == ['c', 'b'] and loads[-1] == 'b'
+
+
+def test_contrast_cache_counts_added_values():
+    cache = ContrastCache(lambda name: {'func': np.zeros(100, dtype=np.uint8)},
+                          budget=250)
+    a, b = cache['a'], cache['b']
+    cache.add('b', b, {'extra': np.zeros(100, dtype=np.uint8)})
+    assert cache.loaded() == ['b'] and cache.nbytes == 200
+
+    # Bundles that were evicted meanwhile get the values, but don't count
+    cache.add('a', a, {'extra': np.zeros(100, dtype=np.uint8)})
+    assert 'extra' in a and cache.loaded() == ['b'] and cache.nbytes == 200
+
+
+def test_contrast_cache_keeps_last_bundle_above_budget(tmp_path):
+    np.save(str(tmp_path / 'func.npy'), np.zeros(1000))
+    mapped = np.load(str(tmp_path / 'func.npy'), mmap_mode='r')
+
+    big = ContrastCache(lambda name: {'func': np.zeros(1000)}, budget=10)
+    big['a'], big['b']
+    assert big.loaded() == ['b']
+
+    # Memory-mapped arrays don't count
+    shared = ContrastCache(lambda name: {'func': mapped}, budget=10)
+    shared['a'], shared['b']
+    assert shared.loaded() == ['a', 'b'] and shared.nbytes == 0
+
+
+def test_disk_cache_prunes_oldest_responses(tmp_path):
+    cache = DiskCache(str(tmp_path), max_bytes=1000)
+    keys = [DiskCache.key('slice', i) for i in range(12)]
+    for i, key in enumerate(keys):
+        cache.set(key, bytes(100))
+        os.utime(cache.path(key), (i, i))  # written in this order
+
+    cache.prune()
+    kept = [key for key in keys if cache.get(key) is not None]
+    assert kept == keys[-9:]
+    assert cache.get(keys[-1]) == bytes(100)
+
+    # A new cache of the same directory prunes it when created
+    DiskCache(str(tmp_path), max_bytes=500)
+    assert [key for key in keys if cache.get(key) is not None] == keys[-4:]
+
+
+def test_disk_cache_without_limit(tmp_path):
+    cache = DiskCache(str(tmp_path / 'cache'))
+    cache.set('ab12', b'png')
+    assert cache.get('ab12') == b'png' and cache.get('cd34') is None
+
+
+def test_load_shared_removes_stale_versions(tmp_path):
+    directory = str(tmp_path)
+    loads = []
+
+    def loader(name):
+        loads.append(name)
+        return {'contrast': np.arange(5.), 'grouplevel': False}
+
+    old, new, busy = ('%040x' % i for i in range(3))
+    bundle = load_shared(loader, 'a', directory, old)
+    assert isinstance(bundle['contrast'], np.memmap) and not bundle['grouplevel']
+    load_shared(loader, 'a', directory, old)
+    assert loads == ['a']
+
+    # Other contrasts and versions that are being saved are kept
+    load_shared(loader, 'b', directory, old)
+    os.makedirs(op.join(directory, 'a-' + busy))
+    with open(op.join(directory, 'a-%s.lock' % busy), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        bundle = load_shared(loader, 'a', directory, new)
+
+    np.testing.assert_array_equal(bundle['contrast'], np.arange(5.))
+    assert loads == ['a', 'b', 'a']
+    assert sorted(os.listdir(directory)) == sorted([
+        'a-' + busy, 'a-%s.lock' % busy, 'a-' + new, 'a-%s.lock' % new,
+        'b-' + old, 'b-%s.lock' % old])
@@ -0,0 +1,178 @@
+import numpy as np
+import pytest
+
+from voxelviz.utils import (fit_glm, model_statistics, r_squared,
+                            calculate_statistics, format_statistics,
+                            load_bundle, standardize, quantize, quantize_rows,
+                            read_row, set_precision, check_precision,
+                            build_pyramid, pyramid_factors, pyramid_level,
+                            slice_window, downsample)
+
+
+def make_glm(n_vox=50, n_vols=30, seed=0):
+    rng = np.random.RandomState(seed)
+    design = np.column_stack([np.ones(n_vols), rng.randn(n_vols, 2)])
+    func = rng.randn(n_vox, 3).dot(design.T) + rng.randn(n_vox, n_vols)
+    return func, design
+
+
+@pytest.mark.parametrize('n_jobs', [1, 3])
+def test_fit_glm_matches_lstsq(n_jobs):
+    func, design = make_glm()
+    betas, sse, ssm = fit_glm(func.reshape(5, 10, -1), design, chunk_size=7,
+                              n_jobs=n_jobs)
+
+    expected = np.linalg.lstsq(design, func.T, rcond=None)[0].T
+    np.testing.assert_allclose(betas.reshape(-1, 3), expected, atol=1e-10)
+
+    y_hat = expected.dot(design.T)
+    np.testing.assert_allclose(sse.ravel(), ((func - y_hat) ** 2).sum(axis=1))
+    np.testing.assert_allclose(
+        ssm.ravel(), ((y_hat - func.mean(axis=1, keepdims=True)) ** 2).sum(axis=1))
+
+
+@pytest.mark.parametrize('grouplevel', [False, True])
+def test_model_statistics_matches_calculate_statistics(grouplevel):
+    func, design = make_glm(n_vox=5)
+    betas, sse, ssm = fit_glm(func, design)
+    stat = model_statistics(sse, ssm, func.shape[1], design.shape[1], grouplevel)
+
+    for y, b, s in zip(func, betas, stat):
+        expected = calculate_statistics(y, design.dot(b), design.shape[1],
+                                        grouplevel)
+        assert format_statistics(s, grouplevel) == expected
+
+
+def test_r_squared():
+    func, design = make_glm(n_vox=5)
+    _, sse, ssm = fit_glm(func, design)
+    r2 = r_squared(sse, ssm)
+    assert ((r2 > 0) & (r2 < 1)).all()
+    assert r_squared(0., 0.) == 0
+
+
+def test_masked_bundle_matches_dense(data):
+    dense = load_bundle(data, 'contrast1')
+    masked = load_bundle(data, 'contrast1', mask=True)
+
+    inside = masked['index'] >= 0
+    assert 0 < inside.sum() < inside.size
+    assert masked['func'].shape[0] == inside.sum()
+    np.testing.assert_array_equal(masked['contrast'], dense['contrast'])
+    np.testing.assert_allclose(masked['bg'], dense['bg'])
+
+    rows, dense_rows = masked['index'][inside], dense['index'][inside]
+    for key in ('func', 'betas', 'stat', 'r2', 'power', 'model_power'):
+        np.testing.assert_allclose(masked[key][rows], dense[key][dense_rows],
+                                   rtol=1e-6, atol=1e-8, err_msg=key)
+
+
+@pytest.mark.parametrize('order', ['C', 'F'])
+def test_standardize(order):
+    rng = np.random.RandomState(0)
+    func = np.asarray(rng.randn(6, 5, 4, 20) * 3 + 10, order=order)
+    func[0, 0, 0] = 7  # without variance
+    original = func.copy()
+
+    out = standardize(func, np.zeros(func.shape, order=order), chunk_size=7,
+                      n_jobs=2)
+
+    np.testing.assert_array_equal(func, original)
+    assert (out[0, 0, 0] == 0).all()
+    expected = (func[1:] - func[1:].mean(axis=-1, keepdims=True)) / \
+        func[1:].std(axis=-1, keepdims=True)
+    np.testing.assert_allclose(out[1:], expected, atol=1e-10)
+    assert standardize(func).dtype == np.float32
+
+    with pytest.raises(ValueError):
+        standardize(func, np.zeros((6, 5, 4, 19)))
+
+
+@pytest.mark.parametrize('dtype', [np.int16, np.uint8])
+def test_quantize_round_trip(dtype):
+    arr = np.random.RandomState(0).randn(100) * 50
+    q, scale, offset = quantize(arr, dtype)
+    assert q.dtype == dtype
+    np.testing.assert_allclose(q * scale + offset, arr, atol=scale / 2 + 1e-12)
+
+
+def test_quantize_rows_round_trip():
+    rng = np.random.RandomState(0)
+    arr = rng.randn(30, 12) * rng.uniform(0.01, 1000, size=(30, 1))
+    arr[3] = 0
+
+    q, scale = quantize_rows(arr, chunk_size=7)
+    bundle = {'power': q, 'power_scale': scale}
+    for row in range(arr.shape[0]):
+        values = read_row(bundle, 'power', row)
+        assert values.dtype == np.float64
+        np.testing.assert_allclose(values, arr[row],
+                                   atol=np.abs(arr[row]).max() / 32767.)
+    assert (read_row(bundle, 'power', 3) == 0).all()
+
+
+def make_precision_bundle():
+    return dict(func=np.full((4, 10), 1e3), power=np.full((4, 6), 1e7),
+                model_power=np.full((4, 6), 1e7), contrast=np.ones((2, 2, 1)),
+                bg=np.full((2, 2, 1), 1e5), betas=np.ones((4, 2)),
+                stat=np.ones(4), r2=np.ones(4))
+
+
+def test_set_precision_float16_keeps_large_values():
+    bundle = set_precision(make_precision_bundle(), 'float16')
+
+    assert bundle['contrast'].dtype == np.float16
+    assert bundle['power'].dtype == bundle['func'].dtype == np.float32
+    assert np.isfinite(bundle['power']).all() and np.isfinite(bundle['bg']).all()
+
+    bundle = set_precision(make_precision_bundle(), 'float16', standardized=True)
+    assert bundle['func'].dtype == np.float16
+
+    with pytest.raises(ValueError):
+        check_precision('float8')
+
+
+def test_set_precision_keeps_memory_maps(tmp_path):
+    bundle = make_precision_bundle()
+    np.save(str(tmp_path / 'bg.npy'), bundle['bg'].astype(np.float32))
+    bundle['bg'] = np.load(str(tmp_path / 'bg.npy'), mmap_mode='r')
+
+    assert isinstance(set_precision(bundle, 'float32')['bg'], np.memmap)
+
+
+def test_build_pyramid():
+    vol = np.random.RandomState(0).rand(130, 70, 20).astype(np.float32)
+    assert pyramid_factors(vol.shape) == [2]
+    assert pyramid_factors((64, 64, 36)) == pyramid_factors((91, 109, 91)) == []
+    assert pyramid_factors((300, 100, 100)) == [2, 4]
+
+    levels = build_pyramid(vol)
+    assert list(levels) == [2] and levels[2].shape == (65, 35, 10)
+    assert levels[2].dtype == np.float32
+    np.testing.assert_allclose(levels[2], downsample(vol, 2), rtol=1e-6)
+    assert build_pyramid(np.zeros((64, 64, 36), dtype=np.int16)) == {}
+
+
+def test_pyramid_level():
+    # The finest level with no more voxels than pixels (else the coarsest)
+    assert pyramid_level([], (300, 300), (100, 100)) == 1
+    assert pyramid_level([2, 4], (256, 200), (512, 512)) == 1
+    assert pyramid_level([2, 4], (256, 200), (200, 200)) == 2
+    assert pyramid_level([2, 4], (256, 200), (100, 100)) == 4
+    assert pyramid_level([2, 4], (256, 200), (10, 10)) == 4
+
+
+def test_slice_window():
+    # Whole slice if not zoomed in
+    assert slice_window((50, 40), 1, (None, None)) == \
+        ((slice(0, 50), slice(0, 40)), dict(x0=0., dx=1, y0=0., dy=1))
+
+    # At level 2, voxel i covers the original voxels 2i and 2i + 1 (and is
+    # centered at 2i + 0.5); the window includes a voxel beyond each edge
+    index, grid = slice_window((50, 40), 2, ([20.2, 30.7], None))
+    assert index == (slice(9, 17), slice(0, 40))
+    assert grid == dict(x0=18.5, dx=2, y0=0.5, dy=2)
+
+    # Ranges beyond the slice (or reversed) are clipped
+    index, _ = slice_window((50, 40), 2, ([120, -10], [35, 200]))
+    assert index == (slice(0, 50), slice(17, 40))
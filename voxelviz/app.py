@@ -1,16 +1,20 @@
 import click
 import os
+import time
+import tempfile
 import warnings
+import threading
 import os.path as op
 from dash import Dash
-from dash.dependencies import Input, Output
+from flask import Response, abort, request, g
+from dash.dependencies import Input, Output, State, ClientsideFunction
 import dash_core_components as dcc
 import dash_html_components as html
-import plotly.graph_objs as go
-import nibabel as nib
 import numpy as np
 from collections import OrderedDict
+from functools import partial
 import json
+import base64
 
 
 @click.command()
@@ -22,7 +26,17 @@ def vxv_cmd(cfg, data, deploy):
     vxv(cfg, data, deploy)
 
 
-def vxv(cfg, data, deploy):
+@click.command()
+@click.option('--cfg', default=None)
+@click.option('--data', default=None)
+@click.option('--threshold', multiple=True, type=float, default=[2.3])
+def warm_cmd(cfg, data, threshold):
+    ''' Pre-renders all slices of all contrasts (at the given thresholds). '''
+
+    vxv(cfg, data, True, prerender=threshold)
+
+
+def vxv(cfg, data, deploy, prerender=None):
     ''' Main function starting the app.
 
     Parameters
@@ -33,6 +47,9 @@ def vxv(cfg, data, deploy):
         Path to directory with data
     deploy : bool
         Whether the app is deployed (True) or run locally (False)
+    prerender : list
+        If given, all slices are rendered (at each of these thresholds) into
+        the response cache and the app is not started
     '''
 
     if cfg is None or data is None:
@@ -47,14 +64,35 @@ def vxv(cfg, data, deploy):
         warnings.warn(msg)
 
     if deploy:
-         from voxelviz.utils import (load_data, index_by_slice, standardize,
-                                     read_design_file, calculate_statistics)
+         from voxelviz.utils import (load_bundle, index_by_slice, data_version,
+                                     read_shape, slice_to_voxel, downsample,
+                                     quantize, format_statistics, read_row,
+                                     pyramid_level, pyramid_factors,
+                                     build_pyramid, slice_window,
+                                     overlay_volume, PRECISIONS)
+         from voxelviz.store import ContrastCache, DiskCache, load_shared
+         from voxelviz.build import (bundle_settings, open_built, build_all,
+                                     BUILD_VERSION)
+         from voxelviz.render import COLORMAPS, render_slice, encode_png
+         from voxelviz.clusters import bundle_clusters, cluster_arrays
+         from voxelviz.metrics import (REGISTRY as metrics, log, enable_log,
+                                       save_snapshot, render_shared)
     else:
-         from .utils import (load_data, index_by_slice, standardize,
-                             read_design_file, calculate_statistics)
+         from .utils import (load_bundle, index_by_slice, data_version,
+                             read_shape, slice_to_voxel, downsample, quantize,
+                             format_statistics, read_row, pyramid_level,
+                             pyramid_factors, build_pyramid, slice_window,
+                             overlay_volume, PRECISIONS)
+         from .store import ContrastCache, DiskCache, load_shared
+         from .build import (bundle_settings, open_built, build_all,
+                             BUILD_VERSION)
+         from .render import COLORMAPS, render_slice, encode_png
+         from .clusters import bundle_clusters, cluster_arrays
+         from .metrics import (REGISTRY as metrics, log, enable_log,
+                               save_snapshot, render_shared)
 
     # Start Dash app
-    app = Dash()
+    app = Dash(assets_folder=op.join(op.dirname(__file__), 'assets'))
     server = app.server
 
     # Default colors of app
@@ -63,34 +101,217 @@ def vxv(cfg, data, deploy):
         text='#D3D3D3'
     )
 
+    # Identifies this app (its data and config) among others on the host
+    app_key = DiskCache.key(op.abspath(data), op.abspath(cfg))[:12]
+
     # Load config (with mappings)
     with open(cfg) as config:
         cfg = json.load(config, object_pairs_hook=OrderedDict)
 
-    # Get the first key (random) from mappings, and load contrast/func
-    # TO REFACTOR: get rid of hidden state
+    # Map the prebuilt bundle of a contrast (see vxv_build) or load its data
+    # in this process or, if shared memory is enabled, once for all workers
+    # (which then map the same memory), by default in a directory of its
+    # own per data directory and settings (such that apps with other
+    # settings don't remove its bundles as outdated)
+    settings = bundle_settings(cfg)
+    # Rendered slices and figures also depend on these settings (e.g., the
+    # MSE map on standardization), so they are part of their cache keys
+    settings_version = DiskCache.key(settings, BUILD_VERSION)[:12]
+    shared_dir = cfg.get('shared_dir', op.join(
+        '/dev/shm', 'voxelviz', DiskCache.key(op.abspath(data), settings)[:12]))
+    if not cfg.get('shared_memory', 0):
+        shared_dir = None
+
+    def load_contrast(name):
+
+        start = time.perf_counter()
+        bundle = open_built(data, name, settings)
+        if bundle is not None:
+            metrics.observe('vxv_contrast_load_seconds',
+                            time.perf_counter() - start, source='bundle')
+            return bundle
+
+        if shared_dir is None:
+            with metrics.timed('vxv_contrast_load_seconds', source='data'):
+                return load_bundle(data, name, **settings)
+
+        version = DiskCache.key(data_version(op.join(data, name)), settings,
+                                BUILD_VERSION)
+        with metrics.timed('vxv_contrast_load_seconds', source='shared'):
+            loader = partial(load_bundle, data, all_clusters=True, **settings)
+            return load_shared(loader, name, shared_dir, version)
+
+    # Keep the data of the most recently used contrasts in memory, such
+    # that switching contrasts is a lookup instead of a reload
+    budget = cfg.get('cache_budget', 2048) * 1024 ** 2
+    bundles = ContrastCache(load_contrast, budget)
+
+    # Load the data before starting the app or, in lazy mode, in the
+    # background, such that (restarted) workers are up right away
+    lazy = cfg.get('lazy', 0)
+    ready = threading.Event()
+    loader_pid = []
+
+    jobs = cfg.get('jobs', 1)
+
+    def warm():
+        # With multiple jobs, the contrasts are built into bundles in
+        # parallel first (see vxv_build), which are then only mapped
+        if jobs != 1:
+            try:
+                build_all(data, list(cfg['mappings'].keys()), settings, jobs)
+            except (OSError, RuntimeError) as e:
+                warnings.warn("Could not build bundles (%s); loading the "
+                              "contrasts one by one instead" % e)
+        bundles.warm(cfg['mappings'].keys())
+        ready.set()
+
+    @server.before_request
+    def start_loading():
+        # Only started on the first request of each process, as threads
+        # don't survive forking (e.g., gunicorn --preload)
+        if lazy and os.getpid() not in loader_pid:
+            loader_pid.append(os.getpid())
+            threading.Thread(target=warm, daemon=True).start()
+
+    @server.route('/health')
+    def health():
+        status = 'ready' if ready.is_set() else 'loading'
+        body = json.dumps({'status': status, 'loaded': bundles.loaded()})
+        return Response(body, status=200 if ready.is_set() else 503,
+                        mimetype='application/json')
+
+    # Record the duration, response size and triggering input of each
+    # callback (and slice image), exposed on /metrics and, optionally,
+    # logged as json lines. Each worker saves its metrics (at most once a
+    # second) in metrics_dir, such that /metrics reports all workers (see
+    # render_shared)
+    if cfg.get('metrics', 1):
+        if cfg.get('metrics_log', None):
+            enable_log(cfg['metrics_log'])
+
+        metrics_dir = cfg.get('metrics_dir', op.join(tempfile.gettempdir(),
+                                                     'voxelviz-metrics', app_key))
+        last_saved = [0.]
+
+        def set_gauges():
+            metrics.set('vxv_contrast_cache_bytes', bundles.nbytes)
+            metrics.set('vxv_contrasts_loaded', len(bundles.loaded()))
+
+        def save_metrics(force=False):
+
+            if metrics_dir is None or (not force and time.time() - last_saved[0] < 1):
+                return
+            last_saved[0] = time.time()
+
+            set_gauges()
+            try:
+                save_snapshot(metrics_dir)
+            except OSError as e:
+                warnings.warn("Could not save metrics in %s (%s)" % (metrics_dir, e))
+
+        @server.before_request
+        def start_timer():
+            g.vxv_start = time.perf_counter()
+
+        @server.after_request
+        def record_request(response):
+
+            if request.endpoint == 'slice_image':
+                callback, trigger = 'slice_image', None
+            elif request.path.endswith('_dash-update-component'):
+                body = request.get_json(silent=True) or {}
+                callback = body.get('output', 'unknown')
+                changed = body.get('changedPropIds') or []
+                trigger = changed[0] if changed else 'initial'
+            else:
+                return response
+
+            seconds = time.perf_counter() - g.get('vxv_start', time.perf_counter())
+            nbytes = response.calculate_content_length() or 0
+
+            metrics.observe('vxv_callback_seconds', seconds, callback=callback)
+            metrics.inc('vxv_callback_response_bytes_total', nbytes,
+                        callback=callback)
+            if trigger is not None:
+                metrics.inc('vxv_callback_triggers_total', callback=callback,
+                            input=trigger)
+            if response.status_code >= 500:
+                metrics.inc('vxv_callback_errors_total', callback=callback)
+
+            log.info(json.dumps(dict(time=time.time(), pid=os.getpid(),
+                                     callback=callback, trigger=trigger,
+                                     status=response.status_code,
+                                     seconds=round(seconds, 6), bytes=nbytes)))
+            save_metrics()
+            return response
+
+        @server.route('/metrics')
+        def metrics_endpoint():
+
+            save_metrics(force=True)
+            try:
+                if metrics_dir is None:
+                    raise OSError
+                body = render_shared(metrics_dir)
+            except OSError:  # only this worker
+                set_gauges()
+                body = metrics.render()
+            return Response(body, mimetype='text/plain; version=0.0.4')
+
+    if not lazy:
+        warm()
+        # The metrics of loading are reported by this process; forked
+        # workers (gunicorn --preload) start without them
+        if cfg.get('metrics', 1):
+            save_metrics(force=True)
+
+    # Render slices as heatmaps, as images (on the server) or in the browser
+    # (from a volume that is downsampled by factor)
+    render = cfg.get('render', 'heatmap')
+    colormap = cfg.get('colormap', 'RdBu')
+    factor = cfg.get('clientside_downsample', 1)
+    volumes = {}
+
+    # Hover events within this time (ms) are coalesced into a single update
+    hover_interval = cfg.get('hover_interval', 100)
+
+    # Cache (of at most cache_size MB) of rendered slices shared by all
+    # workers, if it can be written
+    cache_dir = cfg.get('cache_dir', op.join(data, '.vxv_cache'))
+    cache = None
+    if cache_dir:
+        try:
+            cache = DiskCache(cache_dir, cfg.get('cache_size', 1024) * 1024 ** 2)
+        except OSError as e:
+            warnings.warn("Could not create the cache of rendered slices (%s); "
+                          "slices are rendered for every request instead" % e)
+
+    # Largest minimum cluster size (in voxels) that can be set
+    max_extent = 10000
+
+    # Get the first key (random) from mappings
     global_contrast_name = list(cfg['mappings'].keys())[0]
-    global_func, global_contrast = load_data(op.join(data, global_contrast_name), load_func=True)
-    global_design = read_design_file(op.join(data, global_contrast_name))
-
-    # Kind of an hack: save on disk which contrast we've loaded
-    # (to avoid reloading the func-data every callback)
-    with open("current_contrast.txt", "w") as text_file:
-        text_file.write(global_contrast_name)
 
-    # timeseries or subjects?
-    grouplevel = global_func.shape[:3] == (91, 109, 91)
+    # timeseries or subjects? (in lazy mode, from the header only)
+    if lazy:
+        volume_shape = read_shape(op.join(data, global_contrast_name + '.feat',
+                                          'stats', 'tstat1.nii.gz'))
+        grouplevel = volume_shape == (91, 109, 91)
+    else:
+        volume_shape = bundles[global_contrast_name]['contrast'].shape
+        grouplevel = bundles[global_contrast_name]['grouplevel']
 
-    # Use the mean as background
+    # Maps of the model fit (see load_bundle) that can be shown instead of
+    # the tstat: the F-value and R² (in %) of timeseries, or the mean
+    # squared error of group-level data; as (label, title of the colorbar)
     if grouplevel:
-        global_bg = nib.load(op.join(op.dirname(__file__),
-                                     'data',
-                                     'standard.nii.gz')).get_data()
+        overlays = OrderedDict([('tstat', ('tstat', 'Z-val')),
+                                ('stat', ('MSE', 'MSE'))])
     else:
-        global_bg = global_func.mean(axis=-1)
-
-    if cfg['standardize']:
-        global_func = standardize(global_func)
+        overlays = OrderedDict([('tstat', ('tstat', 'Z-val')),
+                                ('stat', ('F', 'F-val')),
+                                ('r2', ('R²', 'R² (%)'))])
 
     # Start layout of app
     app.layout = html.Div(
@@ -150,7 +371,13 @@ def vxv(cfg, data, deploy):
 
                 html.Div(className='row', children=[
 
-                    dcc.Graph(id='brainplot', animate=False, config={'displayModeBar': False})
+                    dcc.Graph(id='brainplot', animate=False, config={'displayModeBar': False}),
+
+                    # Quantized volumes of the current contrast (clientside rendering only)
+                    dcc.Store(id='volume'),
+
+                    # Size and zoom of the brainplot (see graph_view)
+                    dcc.Store(id='view')
 
                 ]),
 
@@ -171,6 +398,46 @@ def vxv(cfg, data, deploy):
                                    marks={i: i for i in np.arange(0, 10.5, 0.5)})
                     ], style={'padding-top': '5px'})
                 ]),
+
+                html.Div(className='row', children=[
+
+                    html.Div(className='two columns', children=[
+
+                        html.P('Overlay:')
+                    ], style={'textAlign': 'center', 'color': colors['text']}),
+
+                    html.Div(className='ten columns', children=[
+
+                        dcc.RadioItems(
+                            id='overlay',
+                            options=[
+                                {'label': label, 'value': key}
+                                for key, (label, _) in overlays.items()
+                            ],
+                            labelStyle={'display': 'inline-block'},
+                            value='tstat')
+                    ], style={'color': colors['text'], 'padding-top': '25px'})
+                ]),
+
+                html.Div(className='row', children=[
+
+                    # Cluster-extent thresholding happens on the server (not
+                    # in clientside mode)
+                    html.Div(className='four columns', children=[
+
+                        html.P('Min. cluster size:', style={'display': 'inline-block',
+                                                             'padding-right': '5px'}),
+                        dcc.Input(id='extent', type='number', min=0, max=max_extent,
+                                  step=1, value=0,
+                                  style={'width': '70px'})
+                    ], style={'color': colors['text'],
+                              'display': 'none' if render == 'clientside' else 'block'}),
+
+                    html.Div(className='eight columns', children=[
+
+                        dcc.Dropdown(id='peak', options=[], placeholder='Jump to peak')
+                    ])
+                ], style={'padding-top': '10px'}),
             ]),
 
             html.Div(className='six columns', children=[
@@ -205,7 +472,16 @@ def vxv(cfg, data, deploy):
 
                 html.Div(className='row', children=[
 
-                    dcc.Graph(id='brainplot_time', animate=False)
+                    dcc.Graph(id='brainplot_time', animate=False),
+
+                    # Hover events are coalesced in the browser: each new point
+                    # schedules one tick of hover_flush, which sends the most
+                    # recent point (voxel) to the server (see assets/voxelviz.js)
+                    dcc.Interval(id='hover_flush', interval=hover_interval,
+                                 n_intervals=0, max_intervals=0),
+                    dcc.Store(id='voxel'),
+                    dcc.Store(id='timeseries'),
+                    dcc.Store(id='colors', data=colors)
 
                 ]),
 
@@ -223,65 +499,455 @@ def vxv(cfg, data, deploy):
     external_css = "https://codepen.io/lukassnoek/pen/Kvzmzv.css"
     app.css.append_css({"external_url": external_css})
 
-    @app.callback(
-    Output(component_id='parameter_value', component_property='children'),
-    [Input(component_id='brainplot_time', component_property='figure'),
-     Input(component_id='voxel_disp', component_property='values')])
-    def update_parameter_statistics(figure, voxel_disp):
-
-        if 'model' in voxel_disp and len(figure['data']) > 1:
-            y = np.array(figure['data'][0]['y'])
-            y_hat = np.array(figure['data'][1]['y'])
-            n_pred = global_design.shape[1]
-            stat_txt = calculate_statistics(y, y_hat, n_pred, grouplevel)
+    def hover_to_voxel(direction, sslice, point, shape):
+
+        if point is None:
+            if grouplevel:
+                x, y = 40, 40
+            else:
+                x, y = 20, 20
         else:
-            stat_txt = ''
+            # Coordinates aren't integers for downsampled slices
+            x = int(round(point['x']))
+            y = int(round(point['y']))
+
+        voxel = slice_to_voxel(direction, sslice, x, y)
+        return tuple(min(max(i, 0), dim - 1) for i, dim in zip(voxel, shape))
+
+    def compact(arr):
+        # Rounds to 5 significant digits to keep the JSON small
+        return [float('%.5g' % val) for val in arr]
+
+    # Heatmaps are sent with as many digits as the precision of the data
+    digits = PRECISIONS[cfg.get('precision', 'float64')][2]
+
+    def compact_image(img):
+        # Masked (i.e., thresholded) voxels are sent as null
+        if digits is None:
+            return img
+        fmt = '%%.%ig' % digits
+        img = np.ma.masked_invalid(img)
+        return [[None if masked else float(fmt % val)
+                 for val, masked in zip(row, row_mask)]
+                for row, row_mask in zip(img.data.tolist(),
+                                         np.ma.getmaskarray(img).tolist())]
+
+    def voxel_signal(bundle, voxel):
+
+        row = bundle['index'][voxel]
+
+        # Voxels outside the mask don't have a timeseries
+        if row < 0:
+            return np.zeros(bundle['func'].shape[-1])
 
-        return stat_txt
+        signal = read_row(bundle, 'func', row)
+
+        if np.all(np.isnan(signal)):
+            signal = np.zeros(signal.size)
+
+        return signal
+
+    # Large slices are sent at a coarser level of the pyramid of the volumes
+    # (see load_bundle), such that they have no more voxels than pixels.
+    # Only then does the server need the size and zoom of the brainplot;
+    # otherwise, zooming happens in the browser only
+    pyramid = cfg.get('pyramid', 1)
+    zoomable = bool(pyramid and pyramid_factors(volume_shape))
+
+    def slice_view(contrast, direction, view):
+        ''' Returns the level (downsampling factor) at which a slice is shown
+        and the ranges (x, y) the brainplot is zoomed in on (or None, also
+        if the zoom is left to the browser). '''
+
+        view = view or {}
+        ranges = (view.get('x'), view.get('y'))
+        factors = bundles[contrast].get('pyramid') or []
+        if not pyramid or not factors:
+            return 1, (None, None)
+
+        dim = 'XYZ'.index(direction)
+        shape = [n for i, n in enumerate(bundles[contrast]['contrast'].shape) if i != dim]
+        extents = [abs(r[1] - r[0]) if r else n for r, n in zip(ranges, shape)]
+        pixels = (view.get('width') or 512, view.get('height') or 512)
+        return pyramid_level(factors, extents, pixels), ranges
+
+    def bundle_levels(bundle, key):
+        # A volume of a bundle at each level of its pyramid (by factor)
+        levels = {1: bundle[key]}
+        levels.update((f, bundle['%s_%i' % (key, f)])
+                      for f in bundle.get('pyramid') or [])
+        return levels
+
+    def level_slice(levels, direction, sslice, level):
+        # Slice of a volume at a level of the pyramid
+        vol = levels[level]
+        dim = 'XYZ'.index(direction)
+        return index_by_slice(direction, min(sslice // level, vol.shape[dim] - 1), vol)
+
+    overlay_maps = {}
+    overlay_lock = threading.Lock()
+
+    def overlay_map(contrast, overlay):
+        ''' Returns the volume shown on top of the background (at each level
+        of the pyramid) and its display range. The maps of the model fit are
+        made from the statistics of all voxels once per contrast (and
+        standardization), when they are first shown. '''
+
+        bundle = bundles[contrast]
+        if overlay == 'tstat':
+            vmax = bundle['contrast_max']
+            return bundle_levels(bundle, 'contrast'), (-vmax, vmax)
+
+        key = (contrast, bundle['version'], settings['standardize_func'], overlay)
+        with overlay_lock:
+            metrics.inc('vxv_render_cache_total', cache='overlay',
+                        result='hit' if key in overlay_maps else 'miss')
+
+            if key not in overlay_maps:
+                # Only the maps of the contrasts in memory are kept
+                for old in [k for k in overlay_maps if k[0] not in bundles]:
+                    del overlay_maps[old]
+
+                vol = overlay_volume(bundle, overlay)
+                levels = {1: vol}
+                if bundle.get('pyramid'):
+                    levels.update(build_pyramid(vol))
+                vmax = float(np.nanmax(vol)) if vol.size else 0.
+                overlay_maps[key] = levels, (0., vmax or 1.)
+
+            return overlay_maps[key]
+
+    # Clusters (and their peaks) of the maps at each step of the threshold
+    # slider: those of the tstat are indexed when a bundle is loaded (see
+    # load_bundle), those of the other maps the first time they are shown
+    # (unless the bundle is built or shared), after which they are kept in
+    # the bundle
+    cluster_locks = {}
+
+    def cluster_index(contrast, overlay):
+
+        bundle = bundles[contrast]
+        index = bundle_clusters(bundle, overlay, step=0.1)
+        if index is not None:
+            return index
+
+        with cluster_locks.setdefault((contrast, overlay), threading.Lock()):
+            if bundle_clusters(bundle, overlay) is None:
+                with metrics.timed('vxv_load_seconds', stage='clusters'):
+                    bundles.add(contrast, bundle, cluster_arrays(bundle, overlay))
+
+        return bundle_clusters(bundle, overlay, step=0.1)
+
+    def overlay_slice(contrast, overlay, direction, sslice, level=1,
+                      threshold=0, extent=0):
+        ''' Returns a slice of the map shown (at a level of the pyramid), in
+        which the voxels of clusters of less than extent voxels (at the
+        threshold) are set to 0. '''
+
+        levels, _ = overlay_map(contrast, overlay)
+        img_slice = level_slice(levels, direction, sslice, level)
+        if extent > 1 and threshold > 0:
+            keep = cluster_index(contrast, overlay).slice_mask(
+                threshold, extent, direction, sslice, level)
+            img_slice = np.where(keep, img_slice, 0)
+        return img_slice
+
+    def slider_threshold(threshold):
+        # Rounds a threshold to a step of the slider (0 to 10 in steps of
+        # 0.1), or returns None if it isn't a number
+        try:
+            threshold = float(threshold)
+        except (TypeError, ValueError):
+            return None
+        if not np.isfinite(threshold):
+            return None
+        return round(min(max(threshold, 0.), 10.), 1)
+
+    def cluster_extent(extent):
+        # The input is empty (None) while typing; extents of 0 and 1 are
+        # the same (no cluster-extent thresholding)
+        try:
+            extent = min(max(int(extent or 0), 0), max_extent)
+        except (TypeError, ValueError):
+            return 0
+        return extent if extent > 1 else 0
+
+    def overlay_colormap(overlay):
+        # The maps of the model fit are non-negative
+        return colormap if overlay == 'tstat' else 'Hot'
+
+    def slice_url(contrast, direction, sslice, threshold, level=1,
+                  overlay='tstat', extent=0):
+        # The version makes sure browsers don't use images of outdated data
+        # (or of other settings)
+        return '/slices/%s/%s/%i/%.1f/%s.png?%s%s%sv=%s-%s' % (
+            contrast, direction, sslice, threshold, overlay_colormap(overlay),
+            'level=%i&' % level if level > 1 else '',
+            'overlay=%s&' % overlay if overlay != 'tstat' else '',
+            'extent=%i&' % extent if extent > 1 else '',
+            bundles[contrast]['version'], settings_version)
+
+    def slice_png(contrast, direction, sslice, threshold, cmap, level=1,
+                  overlay='tstat', extent=0):
+
+        bundle = bundles[contrast]
+        key = DiskCache.key('slice', bundle['version'], contrast, direction,
+                            sslice, threshold, cmap, level, overlay,
+                            settings_version, extent)
+        png = cache.get(key) if cache else None
+        metrics.inc('vxv_render_cache_total', cache='png',
+                    result='miss' if png is None else 'hit')
+
+        if png is None:
+            with metrics.timed('vxv_render_seconds', stage='png'):
+                _, img_range = overlay_map(contrast, overlay)
+                rgb = render_slice(level_slice(bundle_levels(bundle, 'bg'), direction,
+                                               sslice, level),
+                                   overlay_slice(contrast, overlay, direction, sslice,
+                                                 level, threshold, extent),
+                                   threshold, bundle['bg_range'], img_range, cmap)
+                png = encode_png(rgb)
+            if cache:
+                cache.set(key, png)
+
+        return key, png
+
+    @server.route('/slices/<contrast>/<direction>/<int:sslice>/<threshold>/<cmap>.png')
+    def slice_image(contrast, direction, sslice, threshold, cmap):
+
+        if (contrast not in cfg['mappings'] or direction not in ('X', 'Y', 'Z')
+                or cmap not in COLORMAPS):
+            abort(404)
+
+        # Only the values the slider can take are rendered (and cached)
+        threshold = slider_threshold(threshold)
+        if threshold is None:
+            abort(404)
+
+        shape = bundles[contrast]['contrast'].shape
+        if not 0 <= sslice < shape['XYZ'.index(direction)]:
+            abort(404)
+
+        level = request.args.get('level', 1, type=int)
+        if level != 1 and level not in (bundles[contrast].get('pyramid') or []):
+            abort(404)
+
+        overlay = request.args.get('overlay', 'tstat')
+        extent = request.args.get('extent', 0, type=int)
+        if overlay not in overlays or not 0 <= extent <= max_extent:
+            abort(404)
+        extent = cluster_extent(extent)
+
+        key, png = slice_png(contrast, direction, sslice, threshold, cmap, level,
+                             overlay, extent)
+
+        # Allows browsers and proxies to serve repeated requests themselves
+        response = Response(png, mimetype='image/png')
+        response.set_etag(key)
+        response.headers['Cache-Control'] = 'public, max-age=86400'
+        return response.make_conditional(request)
 
     @app.callback(
         Output(component_id='slice', component_property='max'),
-        [Input(component_id='direction', component_property='value')])
-    def update_slice_slider(direction):
+        [Input(component_id='direction', component_property='value'),
+         Input(component_id='contrast', component_property='value')])
+    def update_slice_slider(direction, contrast):
 
-        # To fix!
-        srange = {'X': global_contrast.shape[0],
-                  'Y': global_contrast.shape[1],
-                  'Z': global_contrast.shape[2]}
+        shape = bundles[contrast]['contrast'].shape
+        srange = {'X': shape[0], 'Y': shape[1], 'Z': shape[2]}
 
         return srange[direction]
 
     @app.callback(
-        Output(component_id='brainplot', component_property='figure'),
-        [Input(component_id='threshold', component_property='value'),
-         Input(component_id='contrast', component_property='value'),
-         Input(component_id='direction', component_property='value'),
-         Input(component_id='slice', component_property='value')])
-    def update_brainplot(threshold, contrast, direction, sslice):
-
-        with open("current_contrast.txt", "r") as text_file:
-            current_contrast = text_file.readlines()[0]
-
-        if contrast != current_contrast:
-            nonlocal global_contrast, global_bg, global_func
-            if global_contrast.shape == (91, 109, 91):
-                global_contrast = load_data(contrast, load_func=False)
-            else:
-                global_func, global_contrast = load_data(op.join(data, contrast), load_func=True)
-                global_bg = global_func.mean(axis=-1)
+        Output(component_id='peak', component_property='options'),
+        [Input(component_id='contrast', component_property='value'),
+         Input(component_id='overlay', component_property='value'),
+         Input(component_id='threshold', component_property='value'),
+         Input(component_id='extent', component_property='value')])
+    def update_peaks(contrast, overlay, threshold, extent):
+        ''' Lists the (highest) peaks of the clusters at the threshold; the
+        value of an option is the voxel (i,j,k) to jump to. '''
+
+        levels, _ = overlay_map(contrast, overlay)
+        peaks = cluster_index(contrast, overlay).list_peaks(
+            slider_threshold(threshold) or 0., cluster_extent(extent), n=20)
+
+        return [{'value': '%i,%i,%i' % voxel,
+                 'label': '%s = %.2f at (%i, %i, %i), %i voxels' % (
+                     overlays[overlay][1], float(levels[1][voxel]),
+                     voxel[0], voxel[1], voxel[2], size)}
+                for voxel, size in peaks]
+
+    # Jumping to a peak shows its slice (in the current direction) and
+    # its timeseries (see flush_hover)
+    app.clientside_callback(
+        ClientsideFunction(namespace='voxelviz', function_name='jump_slice'),
+        Output(component_id='slice', component_property='value'),
+        [Input(component_id='peak', component_property='value')],
+        [State(component_id='direction', component_property='value'),
+         State(component_id='slice', component_property='value')])
+
+    if render == 'clientside':
+        # Slicing and thresholding happen in the browser (see assets/voxelviz.js);
+        # the server only sends the volumes when the contrast changes
+        app.clientside_callback(
+            ClientsideFunction(namespace='voxelviz', function_name='render_slice'),
+            Output(component_id='brainplot', component_property='figure'),
+            [Input(component_id='volume', component_property='data'),
+             Input(component_id='threshold', component_property='value'),
+             Input(component_id='direction', component_property='value'),
+             Input(component_id='slice', component_property='value')])
+
+        @app.callback(
+            Output(component_id='volume', component_property='data'),
+            [Input(component_id='contrast', component_property='value'),
+             Input(component_id='overlay', component_property='value')])
+        def update_volume(contrast, overlay):
+
+            bundle = bundles[contrast]
+            key = '%s-%s-%s' % (contrast, bundle['version'], overlay)
+
+            metrics.inc('vxv_render_cache_total', cache='volume',
+                        result='hit' if key in volumes else 'miss')
+
+            if key not in volumes:
+                bg, bg_scale, bg_offset = quantize(downsample(bundle['bg'], factor),
+                                                   np.uint8)
+                levels, (vmin, vmax) = overlay_map(contrast, overlay)
+                stat, stat_scale, _ = quantize(downsample(levels[1], factor),
+                                               np.int16)
+                volumes[key] = dict(
+                    key=key, shape=stat.shape, factor=factor,
+                    bg=base64.b64encode(bg.tobytes()).decode(),
+                    bg_scale=bg_scale, bg_offset=bg_offset,
+                    stat=base64.b64encode(stat.astype('<i2').tobytes()).decode(),
+                    stat_scale=stat_scale, vmin=vmin, vmax=vmax,
+                    colorscale=overlay_colormap(overlay),
+                    label=overlays[overlay][1],
+                    title='Activation pattern: %s' % cfg['mappings'][contrast],
+                    colors=colors)
+
+            return volumes[key]
+    else:
+        @app.callback(
+            Output(component_id='brainplot', component_property='figure'),
+            [Input(component_id='threshold', component_property='value'),
+             Input(component_id='contrast', component_property='value'),
+             Input(component_id='direction', component_property='value'),
+             Input(component_id='slice', component_property='value'),
+             Input(component_id='overlay', component_property='value'),
+             Input(component_id='extent', component_property='value')] +
+            ([Input(component_id='view', component_property='data')]
+             if zoomable else []))
+        def update_brainplot(threshold, contrast, direction, sslice, overlay,
+                             extent, view=None):
+
+            level, ranges = slice_view(contrast, direction, view)
+            return cached_brainplot_figure(slider_threshold(threshold) or 0., contrast,
+                                           direction, sslice, level, ranges,
+                                           overlay, cluster_extent(extent))
+
+        if zoomable:
+            app.clientside_callback(
+                ClientsideFunction(namespace='voxelviz', function_name='graph_view'),
+                Output(component_id='view', component_property='data'),
+                [Input(component_id='brainplot', component_property='relayoutData')],
+                [State(component_id='view', component_property='data')])
+
+    def cached_brainplot_figure(threshold, contrast, direction, sslice,
+                                level=1, ranges=(None, None), overlay='tstat',
+                                extent=0):
+
+        # Zoomed-in slices at a coarser level (only the visible part) are
+        # hardly ever requested twice; at the finest level, the whole slice
+        # is sent and only the zoom of the figure differs
+        if cache is None or (level > 1 and any(ranges)):
+            with metrics.timed('vxv_render_seconds', stage='figure'):
+                return brainplot_figure(threshold, contrast, direction, sslice,
+                                        level, ranges, overlay, extent)
+
+        key = DiskCache.key('brainplot', bundles[contrast]['version'], render,
+                            colormap, digits, contrast,
+                            cfg['mappings'][contrast], direction, sslice,
+                            threshold, level, overlay, settings_version,
+                            extent)
+        figure = cache.get(key)
+        metrics.inc('vxv_render_cache_total', cache='figure',
+                    result='miss' if figure is None else 'hit')
+
+        if figure is None:
+            from plotly.utils import PlotlyJSONEncoder
+            with metrics.timed('vxv_render_seconds', stage='figure'):
+                figure = brainplot_figure(threshold, contrast, direction, sslice,
+                                          level, overlay=overlay, extent=extent)
+            figure = json.dumps(figure, cls=PlotlyJSONEncoder).encode()
+            cache.set(key, figure)
+
+        return keep_zoom(json.loads(figure.decode()), ranges)
+
+    def keep_zoom(figure, ranges):
+        # Keep the zoom when scrolling through slices
+        for axis, rng in zip(('xaxis', 'yaxis'), ranges):
+            figure['layout'][axis].update(
+                dict(autorange=False, range=list(rng)) if rng else dict(autorange=True))
+        return figure
 
-            with open("current_contrast.txt", "w") as text_file:
-                text_file.write(contrast)
+    def brainplot_figure(threshold, contrast, direction, sslice, level=1,
+                         ranges=(None, None), overlay='tstat', extent=0):
 
-        bg_slice = index_by_slice(direction, sslice, global_bg)
-        img_slice = index_by_slice(direction, sslice, global_contrast)
+        import plotly.graph_objs as go
 
-        bg_map = go.Heatmap(z=bg_slice.T, colorscale='Greys', showscale=False,
-                            hoverinfo="none", name='background')
+        bundle = bundles[contrast]
+        _, (vmin, vmax) = overlay_map(contrast, overlay)
+        cmap = overlay_colormap(overlay)
+        colorbar = {'thickness': 20, 'title': overlays[overlay][1], 'x': -.1}
 
-        tmp = np.ma.masked_where(np.abs(img_slice) < threshold, img_slice)
-        func_map = go.Heatmap(z=tmp.T, opacity=1, name='Activity map',
-                              colorbar={'thickness': 20, 'title': 'Z-val', 'x': -.1})
+        # Only the visible part of a zoomed-in slice at a coarser level is
+        # sent (the clusters of the slice rendered as image are only needed
+        # for the image)
+        if render == 'image':
+            img_slice = overlay_slice(contrast, overlay, direction, sslice, level)
+        else:
+            img_slice = overlay_slice(contrast, overlay, direction, sslice, level,
+                                      threshold, extent)
+        window, grid = slice_window(img_slice.shape, level,
+                                    ranges if level > 1 else (None, None))
+
+        if render == 'image':
+            # The slice is rendered on the server (see slice_image); the
+            # (invisible) heatmap of zeros only serves hovering and the colorbar
+            dim = 'XYZ'.index(direction)
+            width, height = [n for i, n in enumerate(bundle['contrast'].shape) if i != dim]
+            data = [go.Heatmap(z=np.zeros(img_slice[window].T.shape, dtype=np.int8),
+                               opacity=0, zmin=vmin, zmax=vmax,
+                               colorscale=cmap, hoverinfo='x+y',
+                               name='Activity map', colorbar=colorbar, **grid)]
+            images = [dict(source=slice_url(contrast, direction, sslice, threshold,
+                                            level, overlay, extent),
+                           xref='x', yref='y', x=-0.5, y=height - 0.5,
+                           sizex=width, sizey=height, sizing='stretch',
+                           layer='below')]
+        else:
+            bg_slice = level_slice(bundle_levels(bundle, 'bg'), direction, sslice,
+                                   level)[window]
+            bg_map = go.Heatmap(z=compact_image(bg_slice.T), colorscale='Greys',
+                                showscale=False, hoverinfo="none",
+                                name='background', **grid)
+
+            img_slice = img_slice[window]
+            tmp = np.ma.masked_where(np.abs(img_slice) < threshold, img_slice)
+            # The maps of the model fit have a fixed range and colorscale
+            fixed = {} if overlay == 'tstat' else dict(zmin=vmin, zmax=vmax,
+                                                       colorscale=cmap)
+            func_map = go.Heatmap(z=compact_image(tmp.T), opacity=1,
+                                  name='Activity map', colorbar=colorbar,
+                                  **dict(grid, **fixed))
+            data = [bg_map, func_map]
+            images = []
+
+        # Keep the zoom when scrolling through slices (see keep_zoom)
+        axes = [dict(autorange=False, range=list(rng)) if rng else dict(autorange=True)
+                for rng in ranges]
 
         layout = go.Layout(autosize=True,
                            margin={'t': 50, 'l': 5, 'r': 5},
@@ -289,130 +955,106 @@ def vxv(cfg, data, deploy):
                            paper_bgcolor=colors['background'],
                            font={'color': colors['text']},
                            title='Activation pattern: %s' % cfg['mappings'][contrast],
-                           xaxis=dict(autorange=True,
-                                      showgrid=False,
+                           images=images,
+                           xaxis=dict(showgrid=False,
                                       zeroline=False,
                                       showline=False,
                                       autotick=True,
                                       ticks='',
-                                      showticklabels=False),
-                           yaxis=dict(autorange=True,
-                                      showgrid=False,
+                                      showticklabels=False,
+                                      **axes[0]),
+                           yaxis=dict(showgrid=False,
                                       zeroline=False,
                                       showline=False,
                                       autotick=True,
                                       ticks='',
-                                      showticklabels=False))
+                                      showticklabels=False,
+                                      **axes[1]))
+
+        return {'data': data, 'layout': layout}
+
+    app.clientside_callback(
+        ClientsideFunction(namespace='voxelviz', function_name='arm_hover'),
+        Output(component_id='hover_flush', component_property='max_intervals'),
+        [Input(component_id='brainplot', component_property='hoverData')],
+        [State(component_id='hover_flush', component_property='n_intervals'),
+         State(component_id='hover_flush', component_property='max_intervals')])
+
+    app.clientside_callback(
+        ClientsideFunction(namespace='voxelviz', function_name='flush_hover'),
+        Output(component_id='voxel', component_property='data'),
+        [Input(component_id='hover_flush', component_property='n_intervals'),
+         Input(component_id='peak', component_property='value')],
+        [State(component_id='brainplot', component_property='hoverData'),
+         State(component_id='direction', component_property='value')])
+
+    app.clientside_callback(
+        ClientsideFunction(namespace='voxelviz', function_name='render_timeseries'),
+        Output(component_id='brainplot_time', component_property='figure'),
+        [Input(component_id='timeseries', component_property='data')],
+        [State(component_id='colors', component_property='data')])
 
-        return {'data': [bg_map, func_map], 'layout': layout}
+    app.clientside_callback(
+        ClientsideFunction(namespace='voxelviz', function_name='render_statistics'),
+        Output(component_id='parameter_value', component_property='children'),
+        [Input(component_id='timeseries', component_property='data')])
 
     @app.callback(
-        Output(component_id='brainplot_time', component_property='figure'),
-        [Input(component_id='threshold', component_property='value'),
-         Input(component_id='contrast', component_property='value'),
+        Output(component_id='timeseries', component_property='data'),
+        [Input(component_id='contrast', component_property='value'),
          Input(component_id='direction', component_property='value'),
          Input(component_id='slice', component_property='value'),
-         Input(component_id='brainplot', component_property='hoverData'),
+         Input(component_id='voxel', component_property='data'),
          Input(component_id='voxel_disp', component_property='values'),
          Input(component_id='datatype', component_property='value')])
-    def update_brainplot_time(threshold, contrast, direction, sslice, hoverData,
-                              voxel_disp, datatype):
-
-        if datatype == 'time':
-            if grouplevel:
-                xtitle = 'Subjects'
-            else:
-                xtitle = 'Time'
-
-            ytitle = 'Activation (contrast estimate)'
-        else:
-            xtitle = 'Frequency (Hz)'
-            ytitle = 'Power'
-
-        with open("current_contrast.txt", "r") as text_file:
-            current_contrast = text_file.readlines()[0]
-
-        if contrast != current_contrast:
-            nonlocal global_contrast, global_func, global_design
-            global_func, global_contrast = load_data(contrast, load_func=True)
-            global_design = read_design_file(op.join(data, contrast))
-            if cfg['standardize']:
-                global_func = standardize(global_func)
-
-            with open("current_contrast.txt", "w") as text_file:
-                text_file.write(contrast)
-
-        if hoverData is None:
-            if grouplevel:
-                x, y = 40, 40
-            else:
-                x, y = 20, 20
-        else:
-            x = hoverData['points'][0]['x']
-            y = hoverData['points'][0]['y']
-
-        img = index_by_slice(direction, sslice, global_func)
-        signal = img[x, y, :].ravel()
-
-        if np.all(np.isnan(signal)):
-            signal = np.zeros(signal.size)
+    def update_timeseries(contrast, direction, sslice, point, voxel_disp,
+                          datatype):
+        ''' Returns the traces of the hovered voxel (and the statistics of its
+        model fit); the figure itself is made in the browser. '''
 
-        if 'model' in voxel_disp and not np.all(signal == 0):
-            betas = np.linalg.lstsq(global_design, signal)[0]
-            signal_hat = betas.dot(global_design.T)
-            fitted_model = go.Scatter(x=np.arange(1, global_func.shape[-1] + 1),
-                                      y=signal_hat,name='Model fit')
+        bundle = bundles[contrast]
+        voxel = hover_to_voxel(direction, sslice, point, bundle['index'].shape)
+        row = bundle['index'][voxel]
+        signal = voxel_signal(bundle, voxel)
+        show_model = 'model' in voxel_disp and not np.all(signal == 0)
 
         if grouplevel:
             datatype = 'time'
-            plottitle = 'Activation across subjects'
-            bcolors = ['rgb(225,20,20)' if sig > 0 else 'rgb(35,53,216)' for sig in signal]
-            bdata = go.Bar(x=np.arange(1, global_func.shape[-1] + 1), y=signal, name='Activity',
-                           marker=dict(color=bcolors,
-                                       line=dict(color='rgb(211,211,211)', width=0.2)))
-        else:
-            plottitle = 'Activation across time'
-            bdata = go.Scatter(x=np.arange(global_func.shape[-1]),
-                               y=signal, name='Activity')
-
-        layout = go.Layout(autosize=True,
-                           margin={'t': 50, 'l': 50, 'r': 5},
-                           plot_bgcolor=colors['background'],
-                           paper_bgcolor=colors['background'],
-                           font={'color': colors['text']},
-                           xaxis=dict(showgrid=True,
-                                      zeroline=True,
-                                      showline=True,
-                                      autotick=True,
-                                      showticklabels=True,
-                                      title=xtitle),
-                           yaxis=dict(autorange=True,
-                                      showgrid=True,
-                                      zeroline=True,
-                                      showline=True,
-                                      autotick=True,
-                                      showticklabels=True,
-                                      title=ytitle),
-                           title=plottitle)
-
-        if 'model' in voxel_disp and not np.all(signal == 0):
-            figure = {'data': [bdata, fitted_model], 'layout': layout}
-        else:
-            figure = {'data': [bdata], 'layout': layout}
 
         if datatype == 'freq':
+            # The spectra of all voxels (and their model fits) are computed
+            # when loading the contrast
+            x = bundle['freqs']
+            y = read_row(bundle, 'power', row) if row >= 0 else np.zeros(x.size)
+            fit = read_row(bundle, 'model_power', row) if show_model else None
+        else:
+            x = np.arange(1, signal.size + 1) if grouplevel else np.arange(signal.size)
+            y = signal
+            fit = (read_row(bundle, 'betas', row).dot(bundle['design'].T)
+                   if show_model else None)
 
-            for i, element in enumerate(figure['data']):
-                from scipy.signal import periodogram
-                dat = element['y']
-                freq, power = periodogram(dat, 0.5, return_onesided=True)
-                element['y'] = power
-                element['x'] = freq
-                figure['data'][i] = element
-
-        return figure
+        if show_model:
+            stat_txt = format_statistics(float(bundle['stat'][row]), grouplevel)
+        else:
+            stat_txt = ''
 
-    if deploy:
+        return dict(x=compact(x) if datatype == 'freq' else x.tolist(), y=compact(y),
+                    fit=None if fit is None else compact(fit),
+                    stat=stat_txt, datatype=datatype, grouplevel=grouplevel)
+
+    if prerender:
+        for contrast in cfg['mappings'].keys():
+            shape = bundles[contrast]['contrast'].shape
+            for direction, n_slices in zip(('X', 'Y', 'Z'), shape):
+                for sslice in range(n_slices):
+                    for threshold in prerender:
+                        threshold = round(threshold, 1)
+                        cached_brainplot_figure(threshold, contrast,
+                                                direction, sslice)
+                        if render == 'image':
+                            slice_png(contrast, direction, sslice, threshold,
+                                      colormap)
+    elif deploy:
         return app, server
     else:
         app.run_server()
@@ -0,0 +1,256 @@
+/*
+ * Clientside callbacks of VoxelViz.
+ *
+ * In the "clientside" render mode, the server sends the (quantized) tstat
+ * and background volume of a contrast once (see update_volume in app.py),
+ * after which slicing and thresholding happen in the browser.
+ *
+ * Hovering is coalesced in the browser (see arm_hover and flush_hover) and
+ * the server only returns the traces of a voxel (see update_timeseries in
+ * app.py), which are turned into a figure here.
+ *
+ * In the other render modes, the size and zoom of the brainplot are sent to
+ * the server (see graph_view) if the slices can be sent at a lower
+ * resolution (see zoomable in app.py), such that it picks the resolution.
+ * Otherwise, zooming happens in the browser only.
+ *
+ * Jumping to a peak (see update_peaks in app.py) sets the slice and the
+ * voxel as if it was hovered (see jump_slice and flush_hover).
+ */
+window.dash_clientside = window.dash_clientside || {};
+
+(function () {
+
+    // Decoded volumes, by key (contrast and version of the data)
+    var decoded = {};
+
+    function decode(b64, ArrayType) {
+        var bytes = atob(b64);
+        var buffer = new ArrayBuffer(bytes.length);
+        var view = new Uint8Array(buffer);
+        for (var i = 0; i < bytes.length; i++) {
+            view[i] = bytes.charCodeAt(i);
+        }
+        return new ArrayType(buffer);
+    }
+
+    function getVolume(volume) {
+        if (!(volume.key in decoded)) {
+            decoded = {};  // only keep the current volume
+            decoded[volume.key] = {
+                bg: decode(volume.bg, Uint8Array),
+                stat: decode(volume.stat, Int16Array)
+            };
+        }
+        return decoded[volume.key];
+    }
+
+    // Returns the slice of a (C-ordered) volume as rows of a heatmap, i.e.,
+    // transposed like slice.T in app.py
+    function getSlice(arr, shape, direction, idx, scale, offset, threshold) {
+        var nx = shape[0], ny = shape[1], nz = shape[2];
+        var cols, rows, at;
+
+        if (direction === 'X') {
+            cols = ny; rows = nz;
+            at = function (c, r) { return (idx * ny + c) * nz + r; };
+        } else if (direction === 'Y') {
+            cols = nx; rows = nz;
+            at = function (c, r) { return (c * ny + idx) * nz + r; };
+        } else {
+            cols = nx; rows = ny;
+            at = function (c, r) { return (c * ny + r) * nz + idx; };
+        }
+
+        var z = new Array(rows);
+        for (var r = 0; r < rows; r++) {
+            var row = new Array(cols);
+            for (var c = 0; c < cols; c++) {
+                var val = arr[at(c, r)] * scale + offset;
+                row[c] = (threshold !== null && Math.abs(val) < threshold) ? null : val;
+            }
+            z[r] = row;
+        }
+        return z;
+    }
+
+    function axis() {
+        return {autorange: true, showgrid: false, zeroline: false,
+                showline: false, ticks: '', showticklabels: false};
+    }
+
+    // Last hovered point that was sent to the server
+    var sent;
+
+    function samePoint(a, b) {
+        return a && b && a.x === b.x && a.y === b.y;
+    }
+
+    // Last peak that was jumped to
+    var jumped = null;
+
+    // Voxel (i, j, k) of a peak, from the value of its option ("i,j,k")
+    function peakVoxel(peak) {
+        return peak ? peak.split(',').map(Number) : null;
+    }
+
+    function hoverPoint(hoverData) {
+        if (!hoverData || !hoverData.points || !hoverData.points.length) {
+            return null;
+        }
+        return {x: hoverData.points[0].x, y: hoverData.points[0].y};
+    }
+
+    window.dash_clientside.voxelviz = {
+
+        // Schedules a single tick of the hover_flush interval (unless the
+        // hovered point was sent already); all hover events until the tick
+        // are coalesced into one update
+        arm_hover: function (hoverData, n_intervals, max_intervals) {
+            var point = hoverPoint(hoverData);
+            if (point === null || samePoint(point, sent)) {
+                return max_intervals;
+            }
+            return n_intervals + 1;
+        },
+
+        // Sends the most recently hovered point to the server or, after
+        // jumping to a peak, the point of the peak in its slice
+        flush_hover: function (n_intervals, peak, hoverData, direction) {
+            var voxel = peakVoxel(peak);
+            if (peak !== jumped && voxel !== null) {
+                jumped = peak;
+                sent = direction === 'X' ? {x: voxel[1], y: voxel[2]} :
+                       direction === 'Y' ? {x: voxel[0], y: voxel[2]} :
+                                           {x: voxel[0], y: voxel[1]};
+                return sent;
+            }
+            jumped = peak;
+            sent = hoverPoint(hoverData);
+            return sent;
+        },
+
+        // Slice of a peak in the current direction
+        jump_slice: function (peak, direction, sslice) {
+            var voxel = peakVoxel(peak);
+            return voxel === null ? sslice : voxel[{X: 0, Y: 1, Z: 2}[direction]];
+        },
+
+        render_timeseries: function (ts, colors) {
+
+            if (!ts) {
+                return {data: [], layout: {}};
+            }
+
+            var data;
+            if (ts.grouplevel) {
+                data = [{type: 'bar', x: ts.x, y: ts.y, name: 'Activity',
+                         marker: {color: ts.y.map(function (sig) {
+                                      return sig > 0 ? 'rgb(225,20,20)' : 'rgb(35,53,216)';
+                                  }),
+                                  line: {color: 'rgb(211,211,211)', width: 0.2}}}];
+            } else {
+                data = [{type: 'scatter', x: ts.x, y: ts.y, name: 'Activity'}];
+            }
+
+            if (ts.fit) {
+                data.push({type: 'scatter', x: ts.x, y: ts.fit, name: 'Model fit'});
+            }
+
+            var freq = ts.datatype === 'freq';
+            function timeAxis(title, autorange) {
+                return {autorange: autorange, showgrid: true, zeroline: true,
+                        showline: true, showticklabels: true, title: title};
+            }
+
+            return {
+                data: data,
+                layout: {
+                    autosize: true,
+                    margin: {t: 50, l: 50, r: 5},
+                    plot_bgcolor: colors.background,
+                    paper_bgcolor: colors.background,
+                    font: {color: colors.text},
+                    xaxis: timeAxis(freq ? 'Frequency (Hz)' : (ts.grouplevel ? 'Subjects' : 'Time')),
+                    yaxis: timeAxis(freq ? 'Power' : 'Activation (contrast estimate)', true),
+                    title: ts.grouplevel ? 'Activation across subjects' : 'Activation across time'
+                }
+            };
+        },
+
+        render_statistics: function (ts) {
+            return ts ? ts.stat : '';
+        },
+
+        // Size (in pixels) of the brainplot and the ranges it is zoomed in
+        // on (null if not), from which the server picks the resolution of
+        // the slices
+        graph_view: function (relayoutData, view) {
+            var graph = document.getElementById('brainplot');
+            var next = {width: graph ? graph.offsetWidth : null,
+                        height: graph ? graph.offsetHeight : null,
+                        x: view ? view.x : null,
+                        y: view ? view.y : null};
+
+            relayoutData = relayoutData || {};
+            ['x', 'y'].forEach(function (axis) {
+                var name = axis + 'axis';
+                if (relayoutData[name + '.autorange']) {
+                    next[axis] = null;
+                } else if ((name + '.range[0]') in relayoutData) {
+                    next[axis] = [relayoutData[name + '.range[0]'],
+                                  relayoutData[name + '.range[1]']];
+                } else if (relayoutData[name + '.range']) {
+                    next[axis] = relayoutData[name + '.range'].slice();
+                }
+            });
+            return next;
+        },
+
+        render_slice: function (volume, threshold, direction, sslice) {
+
+            if (!volume) {
+                return {data: [], layout: {}};
+            }
+
+            var vol = getVolume(volume);
+            var factor = volume.factor;
+            var dim = {X: 0, Y: 1, Z: 2}[direction];
+            var idx = Math.min(Math.floor(sslice / factor), volume.shape[dim] - 1);
+
+            // Places the (downsampled) voxels at their original coordinates
+            var grid = {x0: (factor - 1) / 2, dx: factor,
+                        y0: (factor - 1) / 2, dy: factor};
+
+            var bg = getSlice(vol.bg, volume.shape, direction, idx,
+                              volume.bg_scale, volume.bg_offset, null);
+            var stat = getSlice(vol.stat, volume.shape, direction, idx,
+                                volume.stat_scale, 0, threshold);
+
+            var bgMap = Object.assign({type: 'heatmap', z: bg, colorscale: 'Greys',
+                                       showscale: false, hoverinfo: 'none',
+                                       name: 'background'}, grid);
+            var funcMap = Object.assign({type: 'heatmap', z: stat, opacity: 1,
+                                         zmin: volume.vmin, zmax: volume.vmax,
+                                         colorscale: volume.colorscale,
+                                         name: 'Activity map',
+                                         colorbar: {thickness: 20, title: volume.label,
+                                                    x: -0.1}},
+                                        grid);
+
+            return {
+                data: [bgMap, funcMap],
+                layout: {
+                    autosize: true,
+                    margin: {t: 50, l: 5, r: 5},
+                    plot_bgcolor: volume.colors.background,
+                    paper_bgcolor: volume.colors.background,
+                    font: {color: volume.colors.text},
+                    title: volume.title,
+                    xaxis: axis(),
+                    yaxis: axis()
+                }
+            };
+        }
+    };
+})();
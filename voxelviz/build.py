@@ -0,0 +1,195 @@
+import click
+import os
+import json
+import os.path as op
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from .utils import load_bundle, data_version, check_precision
+from .store import save_bundle, open_bundle
+
+try:  # only available on POSIX systems
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Bump this whenever the contents of the bundles change
+BUILD_VERSION = 5
+
+
+@click.command()
+@click.option('--cfg', default=None)
+@click.option('--data', default=None)
+@click.option('--force', is_flag=True, default=False)
+@click.option('--jobs', default=None, type=int)
+def build_cmd(cfg, data, force, jobs):
+    ''' Compiles the contrasts of a config-file into bundles (using all
+    cores, unless the number of jobs is given). '''
+
+    with open(cfg) as config:
+        cfg = json.load(config, object_pairs_hook=OrderedDict)
+
+    def report(name):
+        print("Built %s" % name)
+
+    names = list(cfg['mappings'].keys())
+    built = build_all(data, names, bundle_settings(cfg), jobs, force, report)
+    for name in names:
+        if name not in built:
+            print("Bundle of %s is up to date" % name)
+
+
+def bundle_settings(cfg):
+    ''' Returns the settings (from a config) that determine the contents of
+    a bundle. '''
+
+    precision = cfg.get('precision', 'float64')
+    check_precision(precision)
+    return dict(standardize_func=cfg['standardize'], mask=cfg.get('mask', 0),
+                precision=precision)
+
+
+def bundle_dir(data, name):
+    return op.join(data, name + '.vxv')
+
+
+def build_all(data, names, settings, jobs=None, force=False, callback=None):
+    ''' Builds the (missing or outdated) bundles of multiple contrasts in
+    parallel: one contrast per process and, if there are more cores than
+    contrasts, multiple threads per contrast.
+
+    Parameters
+    ----------
+    data : str
+        Path to directory with data
+    names : list
+        Names of the contrasts
+    settings : dict
+        Keyword arguments of load_bundle (see bundle_settings)
+    jobs : int
+        Number of cores to use (default: all)
+    force : bool
+        Whether to rebuild bundles that are up to date
+    callback : callable
+        Called with the name of each contrast once it is built
+
+    Returns
+    -------
+    built : list
+        Names of the contrasts that were built (by this process)
+    '''
+
+    todo = [name for name in names
+            if force or open_built(data, name, settings) is None]
+    if not todo:
+        return []
+
+    # Multiple processes (e.g., gunicorn workers) may build the same data
+    # at once: each bundle is built by the process that locks it, after
+    # which the others wait for those they couldn't lock
+    locks, waiting = [], []
+    try:
+        mine = []
+        for name in todo:
+            lock = open(bundle_dir(data, name) + '.lock', 'w')
+            if fcntl is None:
+                locks.append(lock)
+                mine.append(name)
+                continue
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                waiting.append(lock)
+                continue
+            locks.append(lock)
+
+            # Built by another process in the meantime?
+            if force or open_built(data, name, settings) is None:
+                mine.append(name)
+
+        _build(data, mine, settings, jobs, callback)
+    finally:
+        for lock in locks:
+            lock.close()
+
+    for lock in waiting:
+        with lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+    return mine
+
+
+def _build(data, names, settings, jobs, callback):
+
+    if not names:
+        return
+
+    jobs = jobs or os.cpu_count() or 1
+    n_procs = min(jobs, len(names))
+    n_threads = max(1, jobs // n_procs)
+
+    if n_procs == 1:
+        for name in names:
+            build_contrast(data, name, settings, n_threads)
+            if callback is not None:
+                callback(name)
+        return
+
+    # Processes are spawned (instead of forked), as the caller may run
+    # threads (e.g., the app loading contrasts in the background)
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(n_procs, mp_context=context) as pool:
+        futures = {pool.submit(build_contrast, data, name, settings, n_threads): name
+                   for name in names}
+        for future in as_completed(futures):
+            future.result()
+            if callback is not None:
+                callback(futures[future])
+
+
+def build_contrast(data, name, settings, n_jobs=1):
+    ''' Compiles a contrast (.feat directory) into a bundle, i.e., a
+    directory (<name>.vxv) with everything needed to visualize it as .npy
+    files, which the app only has to memory-map.
+
+    Parameters
+    ----------
+    data : str
+        Path to directory with data
+    name : str
+        Name of the contrast (i.e., the .feat directory without extension)
+    settings : dict
+        Keyword arguments of load_bundle (see bundle_settings)
+    n_jobs : int
+        Number of threads used for the model fit and spectra
+    '''
+
+    bundle = load_bundle(data, name, n_jobs=n_jobs, all_clusters=True,
+                         **settings)
+    bundle.update(build=BUILD_VERSION, settings=settings)
+
+    # Arrays are copied (instead of referring to the caches in the .feat
+    # directory), such that a bundle can be deployed on its own
+    save_bundle(bundle, bundle_dir(data, name), link=False)
+
+
+def open_built(data, name, settings):
+    ''' Opens the bundle of a contrast built with build_contrast, or returns
+    None if there is none or it is outdated (i.e., built by another version,
+    with other settings or from other source data). If the .feat directory
+    is absent (e.g., when deploying only the bundles), the bundle is used
+    as is. '''
+
+    dst = bundle_dir(data, name)
+    if not op.isfile(op.join(dst, 'bundle.json')):
+        return None
+
+    bundle = open_bundle(dst)
+    if bundle.get('build') != BUILD_VERSION or bundle.get('settings') != settings:
+        return None
+
+    feat_dir = op.join(data, name)
+    if op.isdir(feat_dir + '.feat') and bundle['version'] != data_version(feat_dir):
+        return None
+
+    return bundle
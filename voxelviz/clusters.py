@@ -0,0 +1,193 @@
+import numpy as np
+from .utils import downsample, index_by_slice, overlay_volume
+
+# Arrays of a cluster index, stored in a bundle as clusters_<overlay>_<name>
+CLUSTER_ARRAYS = ('order', 'rank', 'counts', 'n_clusters', 'labels', 'sizes',
+                  'peaks')
+
+
+def index_clusters(vol, step=0.1, max_threshold=10.):
+    ''' Labels the connected clusters (and finds their peaks) of a
+    statistical map at each step of the threshold slider (see ClusterIndex).
+
+    Parameters
+    ----------
+    vol : numpy array
+        Statistical map (3D)
+    step : float
+        Step of the threshold slider
+    max_threshold : float
+        Highest threshold of the slider
+
+    Returns
+    -------
+    arrays : dict
+        With keys order (voxels sorted by their absolute value, descending),
+        rank (volume with the position of each voxel in order), counts and
+        n_clusters (number of voxels above the threshold and clusters at each
+        step), and labels, sizes and peaks (of all steps, concatenated)
+    '''
+
+    from scipy import ndimage
+
+    vol = np.nan_to_num(np.asarray(vol, dtype=np.float32))
+    absval = np.abs(vol).ravel()
+
+    order = np.argsort(-absval, kind='stable').astype(np.int32)
+    rank = np.empty(absval.size, dtype=np.int32)
+    rank[order] = np.arange(absval.size, dtype=np.int32)
+
+    sorted_abs = absval[order]
+    vmax = float(sorted_abs[0]) if absval.size else 0.
+    n_steps = int(np.floor(min(vmax, max_threshold) / step + 1e-6))
+    structure = ndimage.generate_binary_structure(3, 3)
+
+    counts, n_clusters, all_labels, all_sizes, all_peaks = [], [], [], [], []
+    for i in range(1, n_steps + 1):
+        # Thresholds are compared in the precision of the map (like the
+        # thresholding of the slices)
+        threshold = np.float32(step_threshold(i, step))
+        n = int(np.searchsorted(-sorted_abs, -threshold, side='right'))
+
+        # Only the part of the volume with voxels above threshold is
+        # labeled, which shrinks as the threshold increases
+        coords = np.unravel_index(order[:n], vol.shape)
+        box = tuple(slice(c.min(), c.max() + 1) for c in coords)
+        part = vol[box]
+        pos, n_pos = ndimage.label(part >= threshold, structure)
+        neg, n_neg = ndimage.label(part <= -threshold, structure)
+        labels = np.where(neg > 0, neg + n_pos, pos).astype(np.int32)
+        labels = labels[tuple(c - b.start for c, b in zip(coords, box))]
+
+        _, first = np.unique(labels, return_index=True)
+        counts.append(n)
+        n_clusters.append(n_pos + n_neg)
+        all_labels.append(labels)
+        all_sizes.append(np.bincount(labels, minlength=n_pos + n_neg + 1))
+        all_peaks.append(np.sort(first))
+
+    def concat(arrays):
+        return np.concatenate(arrays).astype(np.int32) if arrays else \
+            np.zeros(0, dtype=np.int32)
+
+    return dict(order=order, rank=rank.reshape(vol.shape),
+                counts=np.array(counts, dtype=np.int64),
+                n_clusters=np.array(n_clusters, dtype=np.int64),
+                labels=concat(all_labels), sizes=concat(all_sizes),
+                peaks=concat(all_peaks))
+
+
+def step_threshold(i, step):
+    # Threshold of the i-th step (as rounded by the app)
+    return round(i * step, 6)
+
+
+def cluster_arrays(bundle, overlay, step=0.1):
+    ''' Indexes the clusters of a map of a bundle (see overlay_volume) and
+    returns the arrays to store in the bundle (see bundle_clusters). '''
+
+    arrays = index_clusters(overlay_volume(bundle, overlay), step)
+    return dict(('clusters_%s_%s' % (overlay, name), arr)
+                for name, arr in arrays.items())
+
+
+def bundle_clusters(bundle, overlay, step=0.1):
+    ''' Returns the cluster index of a map of a bundle, or None if it isn't
+    indexed (yet; see cluster_arrays). '''
+
+    keys = ['clusters_%s_%s' % (overlay, name) for name in CLUSTER_ARRAYS]
+    if not all(key in bundle for key in keys):
+        return None
+    return ClusterIndex(dict((name, bundle[key])
+                             for name, key in zip(CLUSTER_ARRAYS, keys)), step)
+
+
+class ClusterIndex(object):
+    ''' Connected clusters (and their peaks) of a statistical map at each
+    step of the threshold slider, such that cluster-extent thresholding and
+    listing the peaks are lookups instead of labeling the volume again.
+
+    The voxels are sorted by their absolute value (descending), so the
+    voxels above a threshold are a prefix of that order. For each step, the
+    cluster of each voxel of that prefix is stored, as well as the size of
+    each cluster and the position of its peak (i.e., its first voxel) in the
+    order. Positive and negative values form separate clusters, whose voxels
+    are connected by faces, edges or corners (like FSL's cluster).
+
+    Parameters
+    ----------
+    arrays : dict
+        Arrays made by index_clusters (which may be memory-mapped)
+    step : float
+        Step of the threshold slider
+    '''
+
+    def __init__(self, arrays, step=0.1):
+
+        self.order = arrays['order']
+        self.rank = arrays['rank']
+        self.shape = self.rank.shape
+        self.step = step
+        self.counts = np.asarray(arrays['counts'])
+
+        # The arrays of each step (views of the concatenated arrays)
+        n_clusters = np.asarray(arrays['n_clusters'])
+        self.labels = split(arrays['labels'], self.counts)
+        self.sizes = split(arrays['sizes'], n_clusters + 1)
+        self.peaks = split(arrays['peaks'], n_clusters)
+
+    def step_index(self, threshold):
+        ''' Returns the step of a threshold (0 if below the first step). '''
+        return int(round(threshold / self.step))
+
+    def cluster_sizes(self, threshold, ranks):
+        ''' Returns the size of the cluster of each voxel (given by its rank;
+        see the rank volume) at a threshold, or 0 for voxels below it. '''
+
+        i = self.step_index(threshold)
+        ranks = np.asarray(ranks)
+        if i < 1 or i > len(self.counts):
+            return np.zeros(ranks.shape, dtype=np.int32)
+
+        above = ranks < self.counts[i - 1]
+        sizes = np.zeros(ranks.shape, dtype=np.int32)
+        sizes[above] = self.sizes[i - 1][self.labels[i - 1][ranks[above]]]
+        return sizes
+
+    def slice_mask(self, threshold, extent, direction, sslice, level=1):
+        ''' Returns which voxels of a slice (at a level of the pyramid, see
+        build_pyramid) are part of clusters of at least extent voxels; at
+        coarser levels, those of which any of the voxels they cover are. '''
+
+        dim = 'XYZ'.index(direction)
+        if level == 1:
+            ranks = index_by_slice(direction, sslice, self.rank)
+            return self.cluster_sizes(threshold, ranks) >= extent
+
+        idx = min(sslice // level, int(np.ceil(self.shape[dim] / float(level))) - 1)
+        slab = [slice(None)] * 3
+        slab[dim] = slice(idx * level, (idx + 1) * level)
+        keep = self.cluster_sizes(threshold, self.rank[tuple(slab)]) >= extent
+        return index_by_slice(direction, 0, downsample(keep, level)) > 0
+
+    def list_peaks(self, threshold, extent=0, n=None):
+        ''' Returns the peaks (voxel (i, j, k) with the highest absolute
+        value) of the clusters of at least extent voxels at a threshold,
+        from highest to lowest, as a list of (voxel, cluster size). '''
+
+        i = self.step_index(threshold)
+        if i < 1 or i > len(self.counts):
+            return []
+
+        labels, sizes = self.labels[i - 1], self.sizes[i - 1]
+        first = np.asarray(self.peaks[i - 1])
+        first = first[sizes[labels[first]] >= max(extent, 1)][:n]
+        voxels = np.column_stack(np.unravel_index(self.order[first], self.shape))
+        return [(tuple(int(c) for c in voxel), int(size))
+                for voxel, size in zip(voxels, sizes[labels[first]])]
+
+
+def split(arr, lengths):
+    # Views of the parts (of the given lengths) of a concatenated array
+    stops = np.cumsum(lengths)
+    return [arr[stop - n:stop] for n, stop in zip(lengths, stops)]
@@ -0,0 +1,253 @@
+import os
+import time
+import json
+import logging
+import os.path as op
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+
+try:  # only available on POSIX systems
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Upper bounds (in seconds) of the buckets of the latency histograms
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Metrics(object):
+    ''' Counters, gauges and latency histograms of a process, which can be
+    rendered in the text format of Prometheus.
+
+    Parameters
+    ----------
+    buckets : tuple
+        Upper bounds (in seconds) of the buckets of the histograms
+    '''
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.values = OrderedDict()
+        self.histograms = OrderedDict()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        ''' Increments a counter (whose name should end with _total). '''
+        key = self._key(name, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        ''' Sets a gauge (or a counter that is kept elsewhere). '''
+        with self.lock:
+            self.values[self._key(name, labels)] = value
+
+    def observe(self, name, seconds, **labels):
+        ''' Adds a duration to a histogram. '''
+        key = self._key(name, labels)
+        with self.lock:
+            empty = ([0] * len(self.buckets), 0., 0)
+            counts, total, n = self.histograms.get(key, empty)
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    counts[i] += 1
+            self.histograms[key] = (counts, total + seconds, n + 1)
+
+    @contextmanager
+    def timed(self, name, **labels):
+        ''' Adds the duration of a block of code to a histogram. '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def clear(self):
+        ''' Removes all metrics (e.g., those inherited by a forked process,
+        which are the parent's). '''
+        self.lock = threading.Lock()  # may have been held while forking
+        self.values = OrderedDict()
+        self.histograms = OrderedDict()
+
+    def snapshot(self):
+        ''' Returns all metrics as a dict that can be saved as json. '''
+
+        with self.lock:
+            return {'values': [[name, labels, value]
+                               for (name, labels), value in self.values.items()],
+                    'histograms': [[name, labels, list(counts), total, n]
+                                   for (name, labels), (counts, total, n)
+                                   in self.histograms.items()]}
+
+    def add(self, snapshot, **labels):
+        ''' Adds the metrics of a snapshot (of another process) to these:
+        counters and histograms are summed, whereas gauges get the given
+        labels (e.g., the pid of the process), or are skipped if none are
+        given. '''
+
+        extra = tuple(labels.items())
+        with self.lock:
+            for name, lbls, value in snapshot['values']:
+                lbls = tuple(tuple(label) for label in lbls)
+                if not name.endswith('_total'):
+                    if not extra:
+                        continue
+                    lbls = tuple(sorted(lbls + extra))
+                key = (name, lbls)
+                self.values[key] = self.values.get(key, 0) + value
+
+            for name, lbls, counts, total, n in snapshot['histograms']:
+                key = (name, tuple(tuple(label) for label in lbls))
+                empty = ([0] * len(self.buckets), 0., 0)
+                old_counts, old_total, old_n = self.histograms.get(key, empty)
+                self.histograms[key] = ([a + b for a, b in zip(old_counts, counts)],
+                                        old_total + total, old_n + n)
+
+    def render(self):
+        ''' Returns all metrics in the text format of Prometheus. '''
+
+        with self.lock:
+            values = list(self.values.items())
+            histograms = [(key, (list(counts), total, n))
+                          for key, (counts, total, n) in self.histograms.items()]
+
+        # The lines of a metric have to be grouped together
+        values.sort(key=lambda item: item[0][0])
+        histograms.sort(key=lambda item: item[0][0])
+
+        lines, typed = [], set()
+
+        def declare(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE %s %s' % (name, kind))
+
+        for (name, labels), value in values:
+            declare(name, 'counter' if name.endswith('_total') else 'gauge')
+            lines.append('%s%s %s' % (name, format_labels(labels), value))
+
+        for (name, labels), (counts, total, n) in histograms:
+            declare(name, 'histogram')
+            bounds = [str(bound) for bound in self.buckets] + ['+Inf']
+            for bound, count in zip(bounds, counts + [n]):
+                lines.append('%s_bucket%s %i' % (
+                    name, format_labels(labels + (('le', bound),)), count))
+            lines.append('%s_sum%s %f' % (name, format_labels(labels), total))
+            lines.append('%s_count%s %i' % (name, format_labels(labels), n))
+
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, str(val).replace('\\', '\\\\')
+                                                        .replace('"', '\\"'))
+                             for key, val in labels)
+
+
+# Metrics of this process, shared by the app and the loaders. Forked
+# processes (e.g., gunicorn workers of a preloaded app) start without the
+# metrics of their parent, which reports those itself (see save_snapshot)
+REGISTRY = Metrics()
+timed = REGISTRY.timed
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=REGISTRY.clear)
+
+# Counters and histograms of the processes that have exited (see
+# render_shared)
+AGGREGATE_FILE = 'exited.json'
+
+
+def save_snapshot(directory, registry=REGISTRY):
+    ''' Saves the metrics of this process in a directory shared by all
+    processes (e.g., gunicorn workers) of an app, as <pid>.json. '''
+
+    from .store import save_json
+
+    if not op.isdir(directory):
+        os.makedirs(directory, exist_ok=True)
+    save_json(op.join(directory, '%i.json' % os.getpid()), registry.snapshot())
+
+
+def render_shared(directory):
+    ''' Returns the metrics of all processes that saved a snapshot in a
+    directory in the text format of Prometheus: counters and histograms
+    are summed (including those of processes that have exited, such that
+    they never decrease), gauges are reported per (running) process with a
+    pid label.
+
+    The snapshots of processes that have exited are added to a single file
+    (AGGREGATE_FILE) and removed, such that the number of files doesn't
+    grow with every worker that is restarted. '''
+
+    from .store import save_json
+
+    with open(op.join(directory, '.lock'), 'a') as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+        exited = Metrics()
+        exited.add(read_snapshot(op.join(directory, AGGREGATE_FILE)) or
+                   {'values': [], 'histograms': []})
+
+        running, stale = Metrics(), []
+        for fname in sorted(os.listdir(directory)):
+            try:
+                pid = int(fname[:-5]) if fname.endswith('.json') else None
+            except ValueError:
+                continue
+            snapshot = read_snapshot(op.join(directory, fname)) if pid else None
+            if snapshot is None:
+                continue
+
+            if pid_exists(pid):
+                running.add(snapshot, pid=pid)
+            else:
+                exited.add(snapshot)
+                stale.append(op.join(directory, fname))
+
+        # Saved before removing the snapshots, such that none get lost
+        if stale:
+            save_json(op.join(directory, AGGREGATE_FILE), exited.snapshot())
+            for path in stale:
+                os.remove(path)
+
+    running.add(exited.snapshot())
+    return running.render()
+
+
+def read_snapshot(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def pid_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:  # exists, but owned by another user
+        return True
+    return True
+
+# Structured log of the requests (one json object per line), if enabled
+log = logging.getLogger('voxelviz.metrics')
+
+
+def enable_log(path):
+    ''' Writes the structured log to a file. '''
+
+    handler = logging.FileHandler(path)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    log.addHandler(handler)
+    log.setLevel(logging.INFO)
+    log.propagate = False
@@ -0,0 +1,87 @@
+import zlib
+import struct
+import numpy as np
+
+# Colormaps as (position, rgb) control points, equal to the corresponding
+# colorscales of Plotly (RdBu is the default colorscale of heatmaps)
+COLORMAPS = {
+    'Greys': [(0, (0, 0, 0)), (1, (255, 255, 255))],
+    'RdBu': [(0, (5, 10, 172)), (0.35, (106, 137, 247)), (0.5, (190, 190, 190)),
+             (0.6, (220, 170, 132)), (0.7, (230, 145, 90)), (1, (178, 10, 28))],
+    'Hot': [(0, (0, 0, 0)), (0.3, (230, 0, 0)), (0.6, (255, 210, 0)),
+            (1, (255, 255, 255))],
+    'Viridis': [(0, (68, 1, 84)), (0.13, (71, 44, 122)), (0.25, (59, 81, 139)),
+                (0.38, (44, 113, 142)), (0.5, (33, 144, 141)), (0.63, (39, 173, 129)),
+                (0.75, (92, 200, 99)), (0.88, (170, 220, 50)), (1, (253, 231, 37))]
+}
+
+
+def apply_colormap(values, vmin, vmax, colormap):
+    ''' Maps values to RGB colors (uint8) by linear interpolation between
+    the control points of a colormap. '''
+
+    points = COLORMAPS[colormap]
+    pos = np.array([p for p, _ in points], dtype=np.float64)
+    rgb = np.array([c for _, c in points], dtype=np.float64)
+
+    if vmax > vmin:
+        values = (values - vmin) / float(vmax - vmin)
+    else:
+        values = np.zeros(values.shape)
+
+    values = np.clip(np.nan_to_num(values), 0, 1)
+    out = np.stack([np.interp(values, pos, rgb[:, i]) for i in range(3)], axis=-1)
+    return out.round().astype(np.uint8)
+
+
+def render_slice(bg_slice, img_slice, threshold, bg_range, img_range,
+                 colormap='RdBu'):
+    ''' Composites the background and the thresholded overlay of a slice
+    into a single RGB image.
+
+    Parameters
+    ----------
+    bg_slice : numpy array
+        Background slice (2D)
+    img_slice : numpy array
+        Overlay slice (2D), e.g., the tstat
+    threshold : float
+        Overlay values with an absolute value below threshold are not shown
+    bg_range, img_range : tuple
+        Values (min, max) mapped to the ends of the colormaps
+    colormap : str
+        Name of the colormap (key of COLORMAPS) of the overlay
+
+    Returns
+    -------
+    rgb : numpy array
+        Image (height, width, 3) in display orientation, i.e., the same
+        orientation as a heatmap of the transposed slices
+    '''
+
+    rgb = apply_colormap(bg_slice, bg_range[0], bg_range[1], 'Greys')
+    overlay = apply_colormap(img_slice, img_range[0], img_range[1], colormap)
+    show = np.abs(np.nan_to_num(img_slice)) >= threshold
+    rgb[show] = overlay[show]
+
+    # Heatmaps draw the first row at the bottom, images at the top
+    return rgb.transpose(1, 0, 2)[::-1]
+
+
+def encode_png(rgb, compression=6):
+    ''' Encodes an RGB image (height, width, 3; uint8) as PNG. '''
+
+    def chunk(tag, data):
+        return (struct.pack('>I', len(data)) + tag + data +
+                struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff))
+
+    height, width = rgb.shape[:2]
+    header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+
+    # Each scanline starts with its filter type (0: none)
+    raw = np.zeros((height, width * 3 + 1), dtype=np.uint8)
+    raw[:, 1:] = np.ascontiguousarray(rgb, dtype=np.uint8).reshape(height, -1)
+
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) +
+            chunk(b'IDAT', zlib.compress(raw.tobytes(), compression)) +
+            chunk(b'IEND', b''))
@@ -0,0 +1,471 @@
+import os
+import re
+import json
+import shutil
+import hashlib
+import threading
+import os.path as op
+import numpy as np
+from collections import OrderedDict
+from .metrics import REGISTRY as metrics
+
+try:  # only available on POSIX systems
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Bump this whenever the layout of the cached files changes
+CACHE_VERSION = 1
+
+# Files of the package itself (e.g., the MNI template) are cached per user
+# instead of within the (possibly read-only or versioned) package
+PACKAGE_DIR = op.dirname(op.abspath(__file__))
+USER_CACHE_DIR = op.join(os.environ.get('XDG_CACHE_HOME',
+                                        op.join(op.expanduser('~'), '.cache')),
+                         'voxelviz')
+
+
+def cache_paths(src):
+    ''' Returns the paths of the uncompressed cache of a NIfTI file and
+    its sidecar (a json-file with info about the source), which are next
+    to the source unless it is part of the package (see USER_CACHE_DIR). '''
+
+    if src.endswith('.nii.gz'):
+        base = src[:-7]
+    else:
+        base = op.splitext(src)[0]
+
+    if op.abspath(base).startswith(PACKAGE_DIR + os.sep):
+        base = op.join(USER_CACHE_DIR, op.relpath(op.abspath(base), PACKAGE_DIR))
+
+    return base + '.npy', base + '.json'
+
+
+def source_stamp(src):
+    ''' Returns info on a source file used to validate its cache. '''
+
+    st = os.stat(src)
+    return {'version': CACHE_VERSION, 'mtime': st.st_mtime, 'size': st.st_size}
+
+
+def is_valid_cache(dst, sidecar, stamp):
+
+    if not op.isfile(dst) or not op.isfile(sidecar):
+        return False
+
+    try:
+        with open(sidecar) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return False
+
+    return all(meta.get(key) == val for key, val in stamp.items())
+
+
+def save_array(dst, arr):
+    ''' Saves an array as .npy "atomically", i.e., other processes either
+    see the complete file or no file at all. '''
+
+    tmp = '%s.%i.tmp' % (dst, os.getpid())
+    with open(tmp, 'wb') as f:
+        np.save(f, arr)
+    os.replace(tmp, dst)
+
+
+def save_json(dst, info):
+
+    tmp = '%s.%i.tmp' % (dst, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(info, f)
+    os.replace(tmp, dst)
+
+
+def load_volume(src):
+    ''' Loads a NIfTI file as a read-only, memory-mapped array.
+
+    The first time a file is loaded, it is decoded once and written to an
+    uncompressed .npy file next to the source (see cache_paths), which is validated against
+    the mtime and size of the source on subsequent loads. All processes
+    (e.g., gunicorn workers) map the same file and thus share its pages
+    through the OS page cache. If the cache cannot be written (e.g., the
+    data is on a read-only location), the data is loaded in memory.
+    '''
+
+    dst, sidecar = cache_paths(src)
+    stamp = source_stamp(src)
+
+    if not is_valid_cache(dst, sidecar, stamp):
+        import nibabel as nib
+        data = np.asanyarray(nib.load(src).dataobj)
+        try:
+            if not op.isdir(op.dirname(dst)):
+                os.makedirs(op.dirname(dst), exist_ok=True)
+            save_array(dst, data)
+            stamp.update(shape=data.shape, dtype=data.dtype.str)
+            save_json(sidecar, stamp)
+        except OSError:
+            return data
+
+    return np.load(dst, mmap_mode='r')
+
+
+class ContrastCache(object):
+    ''' Keeps the most recently used bundles of loaded data (one per
+    contrast) in memory within a budget (in bytes).
+
+    Parameters
+    ----------
+    loader : callable
+        Function that loads the bundle (dict) of a contrast given its name
+    budget : int
+        Maximum number of bytes held by the cache; memory-mapped arrays
+        don't count, as they are shared through the OS page cache. The most
+        recently used bundle is always kept, even if it exceeds the budget.
+    '''
+
+    def __init__(self, loader, budget):
+        self.loader = loader
+        self.budget = budget
+        self.bundles = OrderedDict()
+        self.sizes = {}
+        self.hits = self.misses = 0
+
+        # Contrasts are loaded outside the main lock (such that lookups of
+        # other contrasts don't wait), but only once at a time per contrast
+        self.lock = threading.Lock()
+        self.loading = {}
+
+    def __contains__(self, name):
+        return name in self.bundles
+
+    def __getitem__(self, name):
+
+        with self.lock:
+            if name in self.bundles:
+                self.hits += 1
+                metrics.inc('vxv_contrast_cache_hits_total')
+                self.bundles.move_to_end(name)
+                return self.bundles[name]
+            self.misses += 1
+            metrics.inc('vxv_contrast_cache_misses_total')
+            loading = self.loading.setdefault(name, threading.Lock())
+
+        with loading:
+            with self.lock:
+                if name in self.bundles:  # loaded by another thread meanwhile
+                    return self.bundles[name]
+
+            bundle = self.loader(name)
+
+            with self.lock:
+                self.bundles[name] = bundle
+                self.sizes[name] = bundle_nbytes(bundle)
+                self.loading.pop(name, None)
+                self._evict()
+
+        return bundle
+
+    def add(self, name, bundle, values):
+        ''' Adds values (e.g., arrays computed when first needed) to the
+        bundle of a contrast, which count in the budget as long as it is
+        kept. '''
+
+        with self.lock:
+            bundle.update(values)
+            if self.bundles.get(name) is bundle:
+                self.sizes[name] = bundle_nbytes(bundle)
+                self._evict()
+
+    @property
+    def nbytes(self):
+        return sum(self.sizes.values())
+
+    def loaded(self):
+        return list(self.bundles.keys())
+
+    def warm(self, names):
+        ''' Loads the bundles of the given contrasts (as far as the budget
+        allows), such that the first lookups don't have to hit the disk. '''
+        for name in names:
+            self[name]
+            if self.nbytes >= self.budget:
+                break
+
+    def _evict(self):
+        while len(self.bundles) > 1 and self.nbytes > self.budget:
+            name, _ = self.bundles.popitem(last=False)
+            del self.sizes[name]
+
+
+def bundle_nbytes(bundle):
+    ''' Returns the number of bytes held in memory by the arrays of a bundle. '''
+    return sum(val.nbytes for val in bundle.values()
+               if isinstance(val, np.ndarray) and not isinstance(val, np.memmap))
+
+
+class DiskCache(object):
+    ''' Cache of rendered responses (bytes) on disk, which is shared by all
+    processes (e.g., gunicorn workers) serving the same data.
+
+    Parameters
+    ----------
+    directory : str
+        Directory to store the cached responses in
+    max_bytes : int
+        Size (in bytes) above which the oldest responses are removed (see
+        prune); None for no limit
+    '''
+
+    def __init__(self, directory, max_bytes=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        if not op.isdir(directory):
+            os.makedirs(directory)
+
+        # The size of the cache is checked whenever this process has
+        # written a tenth of max_bytes since the last check
+        self.lock = threading.Lock()
+        self.written = 0
+        if max_bytes is not None:
+            self.prune()
+
+    @staticmethod
+    def key(*parts):
+        return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+    def path(self, key):
+        return op.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        try:
+            with open(self.path(key), 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def set(self, key, value):
+        ''' Stores a response; failing to do so (e.g., on a full disk) only
+        means that it is rendered again. '''
+
+        dst = self.path(key)
+        tmp = '%s.%i.tmp' % (dst, os.getpid())
+        try:
+            if not op.isdir(op.dirname(dst)):
+                os.makedirs(op.dirname(dst), exist_ok=True)
+            with open(tmp, 'wb') as f:
+                f.write(value)
+            os.replace(tmp, dst)
+        except OSError:
+            if op.isfile(tmp):
+                os.remove(tmp)
+            return
+
+        if self.max_bytes is not None:
+            with self.lock:
+                self.written += len(value)
+                check = self.written >= self.max_bytes // 10
+                if check:
+                    self.written = 0
+            if check:
+                self.prune()
+
+    def prune(self):
+        ''' Removes the least recently written responses until the cache
+        takes up at most 90% of max_bytes. '''
+
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                path = op.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:  # removed by another process
+                    continue
+                files.append((st.st_mtime, st.st_size, path))
+
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= 0.9 * self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+def load_timeseries(src, mask=None, chunk_size=4):
+    ''' Loads a 4D NIfTI file as a read-only, memory-mapped, voxel-major
+    array (n_voxels, t), such that the timeseries of a voxel is a single
+    contiguous read.
+
+    Rows are ordered like the voxels in a NIfTI file (i.e., the first axis
+    changes fastest). If a (boolean) mask is given, only the voxels within
+    the mask are included. The array is cached as <name>.vm.npy (or
+    <name>.masked.npy) next to the source and built once from the (cached)
+    4D data, chunk_size z-slices at a time.
+    '''
+
+    base = cache_paths(src)[0][:-4]
+    stamp = source_stamp(src)
+
+    if mask is None:
+        dst, sidecar = base + '.vm.npy', base + '.vm.json'
+    else:
+        dst, sidecar = base + '.masked.npy', base + '.masked.json'
+        stamp['mask'] = hashlib.sha1(np.packbits(mask, axis=None)).hexdigest()
+
+    if is_valid_cache(dst, sidecar, stamp):
+        return np.load(dst, mmap_mode='r')
+
+    func = load_volume(src)
+    n_t = func.shape[-1]
+
+    if mask is None:
+        mask = np.ones(func.shape[:3], dtype=bool)
+
+    shape = (int(mask.sum()), n_t)
+
+    # If the cache cannot be written, the array is built in memory
+    tmp = '%s.%i.tmp' % (dst, os.getpid())
+    try:
+        out = np.lib.format.open_memmap(tmp, mode='w+', dtype=func.dtype,
+                                        shape=shape)
+    except OSError:
+        tmp, out = None, np.empty(shape, dtype=func.dtype)
+
+    start = 0
+    for k in range(0, func.shape[2], chunk_size):
+        block_mask = mask[:, :, k:k + chunk_size].ravel(order='F')
+        block = func[:, :, k:k + chunk_size, :].reshape((-1, n_t), order='F')
+        out[start:start + block_mask.sum()] = block[block_mask]
+        start += block_mask.sum()
+
+    if tmp is None:
+        return out
+
+    out.flush()
+    del out
+    os.replace(tmp, dst)
+    stamp.update(shape=shape, dtype=func.dtype.str, vshape=func.shape[:3])
+    save_json(sidecar, stamp)
+
+    return np.load(dst, mmap_mode='r')
+
+
+def save_bundle(bundle, directory, link=True):
+    ''' Saves a bundle in a directory: arrays as .npy files and all other
+    values in a json-file. If link is True, arrays that are memory-mapped
+    .npy files already are saved as a reference to that file. '''
+
+    if not op.isdir(directory):
+        os.makedirs(directory)
+
+    meta, files = {}, {}
+    for key, val in bundle.items():
+        if not isinstance(val, np.ndarray):
+            meta[key] = val
+        elif link and is_npy_file(val):
+            files[key] = op.abspath(val.filename)
+        else:
+            save_array(op.join(directory, key + '.npy'), val)
+            files[key] = key + '.npy'
+
+    # The json-file is written last, as it marks the bundle as complete
+    save_json(op.join(directory, 'bundle.json'), {'meta': meta, 'files': files})
+
+
+def open_bundle(directory):
+    ''' Opens a bundle saved with save_bundle, memory-mapping its arrays
+    (read-only). '''
+
+    with open(op.join(directory, 'bundle.json')) as f:
+        info = json.load(f)
+
+    bundle = info['meta']
+    for key, fname in info['files'].items():
+        bundle[key] = np.load(op.join(directory, fname), mmap_mode='r')
+
+    return bundle
+
+
+def is_npy_file(arr):
+    ''' Checks whether an array is a memory-mapped .npy file as a whole. '''
+
+    if not isinstance(arr, np.memmap) or not str(arr.filename).endswith('.npy'):
+        return False
+
+    whole = np.load(arr.filename, mmap_mode='r')
+    return whole.shape == arr.shape and whole.dtype == arr.dtype and \
+        arr.offset == whole.offset
+
+
+def load_shared(loader, name, directory, version=''):
+    ''' Returns the bundle of a contrast from a directory shared by all
+    processes (e.g., on /dev/shm), such that they all map the same memory.
+
+    The first process asking for a bundle loads it with loader and saves it
+    (while holding a lock); all other processes wait for it and attach. The
+    version (e.g., a hash of the data and settings) is part of the bundle's
+    path, such that outdated bundles are never used; they are removed once
+    a new version is saved (see remove_stale).
+    '''
+
+    dst = op.join(directory, '%s-%s' % (name, version) if version else name)
+    if not op.isdir(directory):
+        os.makedirs(directory, exist_ok=True)
+
+    while True:
+        with open(dst + '.lock', 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                # The lock file was removed (with its bundle, see
+                # remove_stale) while waiting for it
+                if not is_same_file(lock, dst + '.lock'):
+                    continue
+
+            if not op.isfile(op.join(dst, 'bundle.json')):
+                save_bundle(loader(name), dst)
+                if version:
+                    remove_stale(directory, name, dst)
+
+            return open_bundle(dst)
+
+
+def is_same_file(f, path):
+    try:
+        return op.samestat(os.fstat(f.fileno()), os.stat(path))
+    except OSError:
+        return False
+
+
+def remove_stale(directory, name, current):
+    ''' Removes the bundles of other versions (see load_shared) of a
+    contrast, and their lock files, from a shared directory, as they take up
+    memory. Bundles that are being saved (i.e., locked) are skipped;
+    processes that still map a removed bundle keep their copy until they
+    unmap it. '''
+
+    pattern = re.compile(re.escape(name) + r'-[0-9a-f]{40}(\.lock)?$')
+    stale = set(op.join(directory, entry[:len(name) + 41])
+                for entry in os.listdir(directory) if pattern.match(entry))
+    stale.discard(current)
+
+    for path in stale:
+        try:
+            lock = open(path + '.lock', 'a')
+        except OSError:
+            continue
+        with lock:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    continue
+            shutil.rmtree(path, ignore_errors=True)
+            # Removed while still locked, such that processes waiting for
+            # it notice (see load_shared)
+            try:
+                os.remove(path + '.lock')
+            except OSError:
+                pass
@@ -4,12 +4,19 @@ import zipfile
 import platform
 import click
 import os.path as op
-import nibabel as nib
 import json
+import warnings
+import hashlib
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from .store import load_volume, load_timeseries, source_stamp
+from .metrics import timed
 
 default_data_dir = op.join(op.dirname(op.dirname(__file__)))
 
+# Background of group-level (MNI) data
+STANDARD_FILE = op.join(op.dirname(__file__), 'data', 'standard.nii.gz')
+
 @click.command()
 @click.option('--directory', default=default_data_dir)
 def download_data(directory):
@@ -52,7 +59,7 @@ def download_data(directory):
 def index_by_slice(direction, sslice, img):
 
     if isinstance(img, str):
-        img = nib.load(img).get_data()
+        img = load_volume(img)
 
     if direction == 'X':
         img = img[sslice, :, :, ...]
@@ -67,17 +74,62 @@ def index_by_slice(direction, sslice, img):
 def load_data(feat_dir, load_func=False):
 
     path = op.join(feat_dir + '.feat')
-    con = nib.load(op.join(path, 'stats', 'tstat1.nii.gz')).get_data()
+    con = load_volume(op.join(path, 'stats', 'tstat1.nii.gz'))
 
     if load_func:
-        func = nib.load(op.join(path, 'filtered_func_data.nii.gz')).get_data()
+        func = load_volume(op.join(path, 'filtered_func_data.nii.gz'))
         return func, con
     else:
         return con
 
 
-def standardize(func):
-    return (func - func.mean(axis=-1, keepdims=True)) / func.std(axis=-1, keepdims=True)
+def standardize(func, out=None, chunk_size=10000, n_jobs=1):
+    ''' Standardizes (z-scores) the timeseries of all voxels, in blocks of
+    chunk_size voxels, such that the temporaries are at most one block
+    (instead of several copies of the data in float64).
+
+    Blocks are taken along the first axis, such that neither func nor out
+    is reshaped (which would copy arrays that aren't C-contiguous, e.g.,
+    4D data in the Fortran order of NIfTI files).
+
+    Parameters
+    ----------
+    func : numpy array
+        Functional data (..., t), e.g., (n_voxels, t) or (x, y, z, t)
+    out : numpy array
+        Array (of the same shape) to write the result to, e.g., a memmap;
+        by default, a new float32 array
+    chunk_size : int
+        Number of voxels per block (at least one index of the first axis)
+    n_jobs : int
+        Number of threads
+
+    Returns
+    -------
+    out : numpy array
+        Standardized data; voxels without variance (e.g., outside the brain)
+        are 0 instead of NaN
+    '''
+
+    if out is None:
+        out = np.empty(func.shape, dtype=np.float32)
+    elif out.shape != func.shape:
+        raise ValueError("out has shape %s instead of %s" % (out.shape, func.shape))
+
+    # Number of voxels per index of the first axis
+    n_inner = int(np.prod(func.shape[1:-1]))
+
+    def standardize_block(rows):
+        y = np.array(func[rows], dtype=np.float64)  # a copy of the block
+        y -= y.mean(axis=-1, keepdims=True)
+        std = np.sqrt((y ** 2).mean(axis=-1, keepdims=True))
+        valid = np.broadcast_to(std > 0, y.shape)
+        out[rows] = np.divide(y, std, out=np.zeros_like(y), where=valid)
+
+    run_chunks(standardize_block, func.shape[0], max(1, chunk_size // n_inner),
+               n_jobs)
+
+    return out
 
 
 def read_design_file(feat_dir):
@@ -94,18 +146,560 @@ def read_design_file(feat_dir):
     return mat
 
 
+def downsample(vol, factor):
+    ''' Downsamples a volume by averaging blocks of factor ** 3 voxels. '''
+
+    if factor == 1:
+        return np.asarray(vol)
+
+    shape = [int(np.ceil(dim / float(factor))) for dim in vol.shape]
+    padded = np.full([dim * factor for dim in shape], np.nan)
+    padded[:vol.shape[0], :vol.shape[1], :vol.shape[2]] = vol
+    blocks = padded.reshape(shape[0], factor, shape[1], factor, shape[2], factor)
+
+    with warnings.catch_warnings():  # blocks outside the brain may be all-NaN
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return np.nanmean(blocks, axis=(1, 3, 5))
+
+
+def pyramid_factors(shape, min_size=64):
+    ''' Returns the factors (2, 4, 8, ...) by which a volume is downsampled
+    as long as it has at least min_size voxels along its largest axis. '''
+
+    factors, factor = [], 2
+    while int(np.ceil(max(shape) / float(factor))) >= min_size:
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+
+def build_pyramid(vol, min_size=64):
+    ''' Returns coarser versions of a volume (as {factor: volume}), see
+    pyramid_factors. '''
+
+    dtype = vol.dtype if vol.dtype.kind == 'f' else np.float32
+    levels, level = {}, vol
+
+    for factor in pyramid_factors(vol.shape, min_size):
+        level = downsample(level, 2).astype(dtype)
+        levels[factor] = level
+
+    return levels
+
+
+def pyramid_level(factors, extents, pixels):
+    ''' Returns the finest level (downsampling factor; 1 or one of factors)
+    at which the visible extents (in voxels) of a slice have no more voxels
+    than pixels (i.e., the coarsest level if none does). '''
+
+    levels = sorted(set([1] + list(factors)))
+    for factor in levels:
+        if all(np.ceil(ext / float(factor)) <= px for ext, px in zip(extents, pixels)):
+            return factor
+    return levels[-1]
+
+
+def slice_window(shape, level, ranges):
+    ''' Returns the part (index) of a slice at a level that is visible
+    given the zoomed-in ranges, and the positions of its voxels (x0, dx,
+    y0 and dy of a heatmap) at the original coordinates. '''
+
+    index, grid = [], {}
+    for n, rng, axis in zip(shape, ranges, 'xy'):
+        start, stop = 0, n
+        if rng:
+            lo, hi = sorted(rng)
+            start = max(0, int(np.floor((lo - (level - 1) / 2.) / level)))
+            stop = min(n, int(np.ceil((hi - (level - 1) / 2.) / level)) + 1)
+        index.append(slice(start, stop))
+        grid[axis + '0'] = start * level + (level - 1) / 2.
+        grid['d' + axis] = level
+    return tuple(index), grid
+
+
+def quantize(arr, dtype=np.int16):
+    ''' Quantizes an array to integers, such that arr ~ q * scale + offset.
+    For signed types the offset is zero (i.e., zero stays zero).
+
+    Returns
+    -------
+    q : numpy array
+        Quantized array
+    scale : float
+    offset : float
+    '''
+
+    info = np.iinfo(dtype)
+    arr = np.nan_to_num(np.asarray(arr, dtype=np.float64))
+    vmin, vmax = (arr.min(), arr.max()) if arr.size else (0., 0.)
+
+    if info.min < 0:
+        offset = 0.
+        scale = max(abs(vmin), abs(vmax)) / float(info.max)
+    else:
+        offset = vmin
+        scale = (vmax - vmin) / float(info.max)
+
+    if scale == 0:
+        scale = 1.
+
+    q = np.round((arr - offset) / scale).astype(dtype)
+    return q, float(scale), float(offset)
+
+
+def quantize_rows(arr, dtype=np.int16, chunk_size=10000):
+    ''' Quantizes each row of a 2D array to (signed) integers with its own
+    scale, such that arr[i] ~ q[i] * scale[i]. '''
+
+    info = np.iinfo(dtype)
+    q = np.zeros(arr.shape, dtype=dtype)
+    scale = np.ones(arr.shape[0], dtype=np.float32)
+
+    for start in range(0, arr.shape[0], chunk_size):
+        rows = slice(start, start + chunk_size)
+        block = np.nan_to_num(np.asarray(arr[rows], dtype=np.float64))
+        vmax = np.abs(block).max(axis=1) if block.shape[1] else 0
+        scale[rows] = np.where(vmax > 0, vmax / float(info.max), 1.)
+        q[rows] = np.round(block / scale[rows, np.newaxis])
+
+    return q, scale
+
+
+# Dtypes of the timeseries/spectra (rows) and of the volumes and other
+# per-voxel arrays of a bundle per precision, and the number of significant
+# digits worth sending to the browser
+PRECISIONS = {
+    'float64': (None, None, None),
+    'float32': (np.float32, np.float32, 7),
+    'float16': (np.float16, np.float16, 4),
+    'int16': (np.int16, np.float32, 5)
+}
+
+
+def check_precision(precision):
+    ''' Raises a ValueError if precision is not a key of PRECISIONS. '''
+
+    if precision not in PRECISIONS:
+        raise ValueError("Unknown precision %r; choose from %s" %
+                         (precision, ', '.join(sorted(PRECISIONS))))
+
+
+def set_precision(bundle, precision, standardized=False):
+    ''' Converts the arrays of a bundle to the given precision (a key of
+    PRECISIONS); float64 leaves them as they are, as do arrays (e.g.,
+    memory-mapped ones) that have the dtype already. With int16, the rows of
+    the timeseries and spectra are quantized, with their scales stored as
+    <key>_scale (see read_row).
+
+    As float16 overflows above 65504 (and has steps of 8 around 10^4), only
+    the tstat, R² and standardized timeseries (and their betas) are kept in
+    float16; the other arrays are kept in float32. '''
+
+    check_precision(precision)
+    rows_dtype, vol_dtype, _ = PRECISIONS[precision]
+    if rows_dtype is None:
+        return bundle
+
+    half = {'contrast', 'r2'} | ({'func', 'betas'} if standardized else set())
+
+    def convert(key, dtype):
+        if dtype == np.float16 and key not in half:
+            dtype = np.float32
+        return bundle[key].astype(dtype, copy=False)
+
+    for key in ('func', 'power', 'model_power'):
+        if bundle[key] is None:
+            continue
+        if rows_dtype == np.int16:
+            bundle[key], bundle[key + '_scale'] = quantize_rows(bundle[key])
+        else:
+            bundle[key] = convert(key, rows_dtype)
+
+    for key in ('contrast', 'bg', 'betas', 'stat', 'r2'):
+        bundle[key] = convert(key, vol_dtype)
+
+    return bundle
+
+
+def read_row(bundle, key, row):
+    ''' Returns a row (e.g., the timeseries of a voxel) of an array of a
+    bundle as float64, undoing the quantization of set_precision. '''
+
+    values = np.asarray(bundle[key][row], dtype=np.float64)
+    if bundle.get(key + '_scale') is not None:
+        values *= bundle[key + '_scale'][row]
+    return values
+
+
+def slice_to_voxel(direction, sslice, x, y):
+    ''' Returns the voxel (i, j, k) corresponding to point (x, y) of a slice. '''
+
+    if direction == 'X':
+        return sslice, x, y
+    elif direction == 'Y':
+        return x, sslice, y
+    else:
+        return x, y, sslice
+
+
+def compute_mask(con, func_file=None, chunk_size=4):
+    ''' Returns a brain mask: the voxels with a (finite) non-zero tstat or,
+    if the tstat isn't masked and a 4D file is given, the voxels of which
+    the timeseries varies. '''
+
+    mask = np.isfinite(con) & (con != 0)
+
+    if func_file is not None and mask.all():
+        func = load_volume(func_file)
+        for k in range(0, mask.shape[2], chunk_size):
+            mask[:, :, k:k + chunk_size] = func[:, :, k:k + chunk_size].std(axis=-1) > 0
+
+    return mask
+
+
+def make_index(mask):
+    ''' Returns a volume with, for each voxel within the mask, its row in
+    the voxel-major data (in NIfTI order), and -1 for the other voxels. '''
+
+    flat_mask = mask.ravel(order='F')
+    index = np.full(flat_mask.size, -1, dtype=np.int32)
+    index[flat_mask] = np.arange(flat_mask.sum(), dtype=np.int32)
+    return index.reshape(mask.shape, order='F')
+
+
+def unmask(values, index, fill=0):
+    ''' Returns a volume with the values of the rows given by index (where
+    negative indices mark voxels without a row). '''
+
+    vol = np.full(index.shape + values.shape[1:], fill, dtype=values.dtype)
+    valid = index >= 0
+    vol[valid] = values[index[valid]]
+    return vol
+
+
+def run_chunks(fn, n, chunk_size, n_jobs=1):
+    ''' Calls fn for each block (slice) of chunk_size of n rows, in n_jobs
+    threads (numpy releases the GIL while crunching the blocks). '''
+
+    chunks = [slice(start, start + chunk_size) for start in range(0, n, chunk_size)]
+
+    if n_jobs > 1 and len(chunks) > 1:
+        with ThreadPoolExecutor(n_jobs) as pool:
+            list(pool.map(fn, chunks))
+    else:
+        for rows in chunks:
+            fn(rows)
+
+
+def fit_glm(func, design, chunk_size=10000, n_jobs=1):
+    ''' Fits the design to the timeseries of all voxels, in blocks of
+    chunk_size voxels (in n_jobs threads).
+
+    Parameters
+    ----------
+    func : numpy array
+        Functional data (..., t), e.g., (x, y, z, t) or (n_voxels, t)
+    design : numpy array
+        Design matrix (t, n_pred)
+
+    Returns
+    -------
+    betas : numpy array
+        Parameter estimates (..., n_pred)
+    sse : numpy array
+        Residual sum of squares (...)
+    ssm : numpy array
+        Model sum of squares (...)
+    '''
+
+    shape = func.shape[:-1]
+    func = np.reshape(func, (-1, func.shape[-1]))
+    n_vox = func.shape[0]
+    pinv = np.linalg.pinv(design).T
+
+    betas = np.zeros((n_vox, design.shape[1]))
+    sse, ssm = np.zeros(n_vox), np.zeros(n_vox)
+
+    def fit(rows):
+        Y = np.nan_to_num(np.asarray(func[rows], dtype=np.float64))
+        betas[rows] = Y.dot(pinv)
+        y_hat = betas[rows].dot(design.T)
+        sse[rows] = ((y_hat - Y) ** 2).sum(axis=1)
+        ssm[rows] = ((y_hat - Y.mean(axis=1, keepdims=True)) ** 2).sum(axis=1)
+
+    run_chunks(fit, n_vox, chunk_size, n_jobs)
+
+    return (betas.reshape(shape + (design.shape[1],)), sse.reshape(shape),
+            ssm.reshape(shape))
+
+
+def model_statistics(sse, ssm, n, n_pred, grouplevel):
+    ''' Computes the model fit statistic (mean squared error for group-level
+    data, F-value otherwise) for (arrays of) residual and model sums of squares. '''
+
+    sse = np.asarray(sse, dtype=np.float64)
+    ssm = np.asarray(ssm, dtype=np.float64)
+
+    if grouplevel:
+        return sse / float(n)
+    else:
+        df1 = np.max([n_pred - 1, 1])
+        df2 = n - df1
+        MSM = ssm / df1
+        with np.errstate(divide='ignore', invalid='ignore'):
+            F = MSM / (sse / df2)
+        return np.where(np.isfinite(F), F, 0)
+
+
+def r_squared(sse, ssm):
+    ''' Computes the proportion of variance explained by the model (R²) for
+    (arrays of) residual and model sums of squares. '''
+
+    sse = np.asarray(sse, dtype=np.float64)
+    ssm = np.asarray(ssm, dtype=np.float64)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r2 = ssm / (ssm + sse)
+    return np.where(np.isfinite(r2), r2, 0)
+
+
+def format_statistics(stat, grouplevel):
+
+    if grouplevel:
+        return 'Model fit (mean squared error): %.3f' % stat
+    else:
+        return 'Model fit (F-test): %s' % str(np.round(stat, 3))
+
+
 def calculate_statistics(y, y_hat, n_pred, grouplevel):
 
     SSE = ((y_hat - y) ** 2).sum()
+    SSM = ((y_hat - y.mean()) ** 2).sum()
+    stat = model_statistics(SSE, SSM, y.size, n_pred, grouplevel)
+    return format_statistics(stat, grouplevel)
+
+
+def read_shape(path):
+    ''' Returns the shape of a NIfTI file (only reading its header). '''
+
+    import nibabel as nib
+    return nib.load(path).shape
+
+
+def read_tr(func_file, default=2.0):
+    ''' Returns the repetition time (in seconds) from the header of a 4D
+    NIfTI file (or default if the header doesn't specify it). '''
+
+    import nibabel as nib
+
+    header = nib.load(func_file).header
+    zooms = header.get_zooms()
+
+    if len(zooms) < 4 or zooms[3] <= 0:
+        return default
+
+    tr = float(zooms[3])
+    units = header.get_xyzt_units()[1]
+    if units == 'msec':
+        tr /= 1000.
+    elif units == 'usec':
+        tr /= 1000000.
 
+    return tr
+
+
+def compute_spectra(func, tr, betas=None, design=None, chunk_size=10000,
+                    n_jobs=1):
+    ''' Computes the power spectra of all timeseries (and, optionally, of
+    their model fits) in blocks of chunk_size voxels (in n_jobs threads).
+
+    Parameters
+    ----------
+    func : numpy array
+        Voxel-major timeseries (n_voxels, t)
+    tr : float
+        Repetition time (in seconds)
+    betas : numpy array
+        Parameter estimates (n_voxels, n_pred)
+    design : numpy array
+        Design matrix (t, n_pred)
+
+    Returns
+    -------
+    freqs : numpy array
+        Frequencies (in Hz)
+    power : numpy array
+        Power of the timeseries (n_voxels, n_freqs)
+    model_power : numpy array
+        Power of the model fits (n_voxels, n_freqs), or None if no betas are given
+    '''
+
+    from scipy.signal import periodogram
+
+    n_vox, n_t = func.shape
+    freqs = np.fft.rfftfreq(n_t, d=tr)
+    power = np.zeros((n_vox, freqs.size), dtype=np.float32)
+    model_power = None if betas is None else np.zeros_like(power)
+
+    def spectra(rows):
+        y = np.nan_to_num(np.asarray(func[rows], dtype=np.float64))
+        power[rows] = periodogram(y, 1.0 / tr, return_onesided=True, axis=-1)[1]
+
+        if betas is not None:
+            y_hat = betas[rows].dot(design.T)
+            model_power[rows] = periodogram(y_hat, 1.0 / tr,
+                                            return_onesided=True, axis=-1)[1]
+
+    run_chunks(spectra, n_vox, chunk_size, n_jobs)
+
+    return freqs, power, model_power
+
+
+def data_version(feat_dir):
+    ''' Returns an identifier of the version of the source data of a
+    contrast, i.e., of all files its bundle is made from (e.g., to
+    invalidate cached renders). '''
+
+    path = op.join(feat_dir + '.feat')
+    sources = [op.join(path, 'stats', 'tstat1.nii.gz'),
+               op.join(path, 'filtered_func_data.nii.gz'),
+               op.join(path, 'design.mat'),
+               STANDARD_FILE]
+    stamps = [sorted(source_stamp(src).items()) for src in sources]
+    return hashlib.sha1(repr(stamps).encode()).hexdigest()[:12]
+
+
+def load_bundle(data, contrast, standardize_func=False, mask=False,
+                precision='float64', n_jobs=1, all_clusters=False):
+    ''' Loads everything needed to visualize a contrast.
+
+    Parameters
+    ----------
+    data : str
+        Path to directory with data
+    contrast : str
+        Name of the contrast (i.e., the .feat directory without extension)
+    standardize_func : bool
+        Whether to standardize the functional data
+    mask : bool
+        Whether to only load (and process) the voxels within the brain
+    precision : str
+        Precision in which the arrays are kept (see set_precision); the
+        model is fit and the spectra are computed in float64 regardless
+    n_jobs : int
+        Number of threads used to standardize the data, fit the model and
+        compute the spectra
+    all_clusters : bool
+        Whether to index the clusters of all maps (see overlay_names),
+        e.g., for bundles that are saved, instead of only those of the
+        tstat (see cluster_arrays)
+
+    Returns
+    -------
+    bundle : dict
+        With keys func (voxel-major timeseries), index (volume with the
+        row of func of each voxel, or -1 outside the mask), contrast, design, bg, grouplevel, betas
+        (parameter estimates), stat (model fit statistic) and r2 (R² of the
+        model fit; betas, stat and r2 are per row of func), freqs, power and model_power (spectra of the
+        timeseries and model fits), bg_range and contrast_max (display
+        ranges), version (of the source data), pyramid (factors of the
+        downsampled versions of contrast and bg, stored as contrast_<factor>
+        and bg_<factor>), the clusters of the tstat (or of each map),
+        stored as clusters_<overlay>_<array> and, with int16 precision, the scales of the rows
+        of func, power and model_power (see read_row)
+    '''
+
+    feat_dir = op.join(data, contrast)
+    path = feat_dir + '.feat'
+    func_file = op.join(path, 'filtered_func_data.nii.gz')
+    # The duration of each stage is recorded (see metrics)
+    with timed('vxv_load_seconds', stage='read'):
+        con = load_volume(op.join(path, 'stats', 'tstat1.nii.gz'))
+        design = read_design_file(feat_dir)
+
+        if mask:
+            brain_mask = compute_mask(con, func_file)
+            func = load_timeseries(func_file, mask=brain_mask)
+        else:
+            brain_mask = np.ones(con.shape, dtype=bool)
+            func = load_timeseries(func_file)
+
+        index = make_index(brain_mask)
+
+    # timeseries or subjects?
+    grouplevel = con.shape == (91, 109, 91)
+
+    # Use the mean as background
+    with timed('vxv_load_seconds', stage='background'):
+        if grouplevel:
+            bg = load_volume(STANDARD_FILE)
+        else:
+            bg = unmask(func.mean(axis=-1), index)
+
+    if standardize_func:
+        with timed('vxv_load_seconds', stage='standardize'):
+            func = standardize(func, n_jobs=n_jobs)
+
+    # Fit the model to all voxels once, such that the model fit and its
+    # statistics are lookups when hovering
+    with timed('vxv_load_seconds', stage='fit'):
+        betas, sse, ssm = fit_glm(func, design, n_jobs=n_jobs)
+        stat = model_statistics(sse, ssm, func.shape[-1], design.shape[1],
+                                grouplevel)
+        r2 = r_squared(sse, ssm)
+
+    # Spectra for the frequency view (only for timeseries)
     if grouplevel:
-        return 'Model fit (mean squared error): %.3f' % (SSE / float(y.size))
+        freqs = power = model_power = None
     else:
-        SSM = ((y_hat - y.mean()) ** 2).sum()
-        df1 = np.max([n_pred - 1, 1])
-        df2 = y.size - df1
-        MSM = SSM / df1
-        F = MSM / (SSE / df2)
-        if np.isnan(F) or np.isinf(np.abs(F)):
-            F = 0
-        return 'Model fit (F-test): %s' % str(np.round(F, 3))
+        with timed('vxv_load_seconds', stage='spectra'):
+            tr = read_tr(func_file)
+            freqs, power, model_power = compute_spectra(func, tr, betas, design,
+                                                         n_jobs=n_jobs)
+
+    # Fixed display ranges, such that colors don't vary across slices
+    bg_range = (float(np.nanmin(bg)), float(np.nanmax(bg)))
+    contrast_max = float(np.nanmax(np.abs(con)))
+
+    bundle = dict(func=func, index=index, contrast=con, design=design, bg=bg,
+                  grouplevel=grouplevel, betas=betas, stat=stat, r2=r2, freqs=freqs,
+                  power=power, model_power=model_power,
+                  bg_range=bg_range, contrast_max=contrast_max,
+                  version=data_version(feat_dir))
+    bundle = set_precision(bundle, precision, standardize_func)
+
+    # Coarser versions of the volumes, for slices with more voxels than pixels
+    factors = []
+    for key in ('contrast', 'bg'):
+        for factor, level in build_pyramid(bundle[key]).items():
+            bundle['%s_%i' % (key, factor)] = level
+            factors.append(factor)
+    bundle['pyramid'] = sorted(set(factors))
+
+    # Clusters of the maps at each step of the threshold slider; those of
+    # the maps of the model fit are otherwise indexed when first shown
+    from .clusters import cluster_arrays
+    with timed('vxv_load_seconds', stage='clusters'):
+        for overlay in overlay_names(grouplevel) if all_clusters else ('tstat',):
+            bundle.update(cluster_arrays(bundle, overlay))
+
+    return bundle
+
+
+def overlay_names(grouplevel):
+    ''' Returns the maps that can be shown on top of the background: the
+    tstat and the model fit statistic, and the R² of timeseries. '''
+    return ('tstat', 'stat') if grouplevel else ('tstat', 'stat', 'r2')
+
+
+def overlay_volume(bundle, overlay):
+    ''' Returns a map of a bundle (see overlay_names) as a volume, with the
+    R² in %. '''
+
+    if overlay == 'tstat':
+        return np.asarray(bundle['contrast'], dtype=np.float32)
+
+    vol = unmask(np.asarray(bundle[overlay], dtype=np.float32), bundle['index'])
+    if overlay == 'r2':
+        vol *= 100
+    return vol